@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""analytics.py - Offline analytics over the chunks written by export.py.
+
+Computes the guess-count distribution, the win rate by attempts_allowed and
+daily trends of games, wins and guesses. Every chunk is folded into running
+totals with vectorized NumPy operations, so memory is bounded by the chunk
+size plus the Game ids used to look up attempts_allowed for older Scores:
+
+    python analytics.py export/ --output report.json
+
+Requires NumPy."""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+from datetime import date
+
+import numpy
+
+from export import SCORE_COLUMNS, GAME_COLUMNS
+
+
+def iter_chunks(directory, kind, columns):
+    """Yields each chunk of a kind as a dict of the named numeric columns"""
+    dtypes = dict(SCORE_COLUMNS + GAME_COLUMNS)
+    for path in sorted(glob.glob(os.path.join(directory, kind + '-*'))):
+        if path.endswith('.npz'):
+            data = numpy.load(path)
+            try:
+                yield dict((column, data[column]) for column in columns)
+            finally:
+                data.close()
+        elif path.endswith('.csv'):
+            with open(path) as chunk:
+                header = next(csv.reader(chunk))
+            values = numpy.loadtxt(path, delimiter=',', skiprows=1, ndmin=2, dtype='int64',
+                                   usecols=[header.index(column) for column in columns])
+            yield dict((column, values[:, index].astype(dtypes[column]))
+                       for index, column in enumerate(columns))
+
+
+def _accumulate(totals, index, weights=None):
+    """Adds the bincount of non-negative indexes to totals, growing it as
+    needed. Returns the new totals."""
+    counts = numpy.bincount(index, weights=weights).astype('float64')
+    if len(counts) > len(totals):
+        counts[:len(totals)] += totals
+        return counts
+    totals[:len(counts)] += counts
+    return totals
+
+
+class AttemptsLookup(object):
+    """attempts_allowed of the exported Games, for Scores stored before
+    Scores recorded it themselves"""
+
+    def __init__(self, directory):
+        ids, attempts = [], []
+        for chunk in iter_chunks(directory, 'games', ('game_id', 'attempts_allowed')):
+            ids.append(chunk['game_id'])
+            attempts.append(chunk['attempts_allowed'])
+        ids = numpy.concatenate(ids) if ids else numpy.zeros(0, 'int64')
+        attempts = numpy.concatenate(attempts) if attempts else numpy.zeros(0, 'int32')
+        order = numpy.argsort(ids)
+        self.ids = ids[order]
+        self.attempts = attempts[order]
+
+    def fill(self, game_ids, attempts_allowed):
+        """Returns attempts_allowed with missing values looked up by Game id;
+        those still unknown stay -1"""
+        missing = (attempts_allowed < 0) & (game_ids >= 0)
+        if not missing.any() or not len(self.ids):
+            return attempts_allowed
+        positions = numpy.searchsorted(self.ids, game_ids[missing])
+        positions[positions == len(self.ids)] = 0
+        found = self.ids[positions] == game_ids[missing]
+        filled = attempts_allowed.copy()
+        filled[numpy.flatnonzero(missing)[found]] = self.attempts[positions[found]]
+        return filled
+
+
+class ScoreAnalytics(object):
+    """Running totals over Score chunks"""
+    COLUMNS = ('game_id', 'date', 'won', 'guesses', 'attempts_allowed')
+
+    def __init__(self, attempts_lookup=None):
+        self.attempts_lookup = attempts_lookup
+        self.scores = 0
+        self.guess_counts = numpy.zeros(0)
+        self.games_by_attempts = numpy.zeros(0)
+        self.wins_by_attempts = numpy.zeros(0)
+        self.unknown_attempts = 0
+        self.first_day = None
+        self.games_by_day = numpy.zeros(0)
+        self.wins_by_day = numpy.zeros(0)
+        self.guesses_by_day = numpy.zeros(0)
+
+    def add(self, chunk):
+        """Folds one chunk of Score columns into the totals"""
+        won = chunk['won'].astype('float64')
+        guesses = chunk['guesses']
+        attempts = chunk['attempts_allowed']
+        if self.attempts_lookup:
+            attempts = self.attempts_lookup.fill(chunk['game_id'], attempts)
+        self.scores += len(won)
+
+        self.guess_counts = _accumulate(self.guess_counts, guesses)
+
+        known = attempts >= 0
+        self.unknown_attempts += int(len(attempts) - known.sum())
+        self.games_by_attempts = _accumulate(self.games_by_attempts, attempts[known])
+        self.wins_by_attempts = _accumulate(self.wins_by_attempts, attempts[known], won[known])
+
+        days = chunk['date'].astype('int64')
+        if not len(days):
+            return
+        first_day = int(days.min())
+        if self.first_day is None:
+            self.first_day = first_day
+        elif first_day < self.first_day:
+            # Shift the daily totals to start at the earlier day.
+            shift = numpy.zeros(self.first_day - first_day)
+            self.games_by_day = numpy.concatenate([shift, self.games_by_day])
+            self.wins_by_day = numpy.concatenate([shift, self.wins_by_day])
+            self.guesses_by_day = numpy.concatenate([shift, self.guesses_by_day])
+            self.first_day = first_day
+        day_index = days - self.first_day
+        self.games_by_day = _accumulate(self.games_by_day, day_index)
+        self.wins_by_day = _accumulate(self.wins_by_day, day_index, won)
+        self.guesses_by_day = _accumulate(self.guesses_by_day, day_index, guesses.astype('float64'))
+
+    def report(self):
+        """Returns the aggregates as a JSON-serializable dict"""
+        played = numpy.flatnonzero(self.games_by_day)
+        games_by_attempts = numpy.maximum(self.games_by_attempts, 1)
+        return {
+            'scores': self.scores,
+            'guess_distribution': dict((int(guesses), int(self.guess_counts[guesses]))
+                                       for guesses in numpy.flatnonzero(self.guess_counts)),
+            'win_rate_by_attempts_allowed': dict(
+                (int(attempts), {'games': int(self.games_by_attempts[attempts]),
+                                 'win_rate': float(self.wins_by_attempts[attempts] / games_by_attempts[attempts])})
+                for attempts in numpy.flatnonzero(self.games_by_attempts)),
+            'unknown_attempts_allowed': self.unknown_attempts,
+            'daily': [{'date': date.fromordinal(self.first_day + int(day)).isoformat(),
+                       'games': int(self.games_by_day[day]),
+                       'win_rate': float(self.wins_by_day[day] / self.games_by_day[day]),
+                       'average_guesses': float(self.guesses_by_day[day] / self.games_by_day[day])}
+                      for day in played],
+        }
+
+
+def analyze(directory):
+    """Returns the report over an export directory"""
+    analytics = ScoreAnalytics(AttemptsLookup(directory))
+    for chunk in iter_chunks(directory, 'scores', ScoreAnalytics.COLUMNS):
+        analytics.add(chunk)
+    return analytics.report()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory', help='output directory of export.py')
+    parser.add_argument('--output', default='report.json')
+    args = parser.parse_args(argv)
+
+    report = analyze(args.directory)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+    print 'Analyzed {} scores; report written to {}'.format(report['scores'], args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -4,17 +4,22 @@ This can also contain game logic. For more complex games it would be wise to
 move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
+import collections
+import datetime
 import logging
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors, taskqueue
 from google.appengine.ext import ndb
 
-from models import User, Game, Score
+from models import User, Game, Score, Leaderboard, AttemptsRemainingShard, UserStats, \
+    ScoreArchive, UserScoreArchive, LEADERBOARD_SIZE
 from models import StringMessage, NewGameForm, GameForm, GameForms, MakeMoveForm, \
-    ScoreForms, LimitResults
-from utils import get_by_urlsafe
+    MakeMovesForm, MoveErrorForm, ScoreForms, LimitResults, UserStatsForm
+from instrumentation import instrumented
+from coalesce import CoalescedTask
+from utils import get_by_urlsafe_async, get_user_async, get_user_keys, get_user_keys_async, \
+    remember_user_key, fetch_page_async, fetch_rows_page, page_list, parse_urlsafe
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
@@ -25,8 +30,26 @@ MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
 
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1, required=True),
                                            email=messages.StringField(2))
-
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+PAGE_REQUEST = endpoints.ResourceContainer(page_size=messages.IntegerField(1),
+                                           page_token=messages.StringField(2))
+USER_NAME_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1, required=True))
+USER_PAGE_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1, required=True),
+                                                page_size=messages.IntegerField(2),
+                                                page_token=messages.StringField(3))
+
+MAX_BATCH_MOVES = 100
+# Games per make_moves commit. Any of them may end in it, adding its Score's
+# entity group and a transactional leaderboard task; a transaction allows at
+# most 5 such tasks, and spans at most 25 entity groups including the User's.
+MAX_GAMES_PER_COMMIT = 5
+COMMIT_FAILED = 'The move could not be saved, please try again!'
+# Prefix of the page tokens of archived Scores, which follow the stored ones.
+ARCHIVE_PAGE_TOKEN = 'archive:'
+
+# Background work triggered from request handlers, at most once per window.
+REBUILD_LEADERBOARD = CoalescedTask('rebuild-leaderboard', '/tasks/rebuild_leaderboard', window=5)
+RECONCILE_AVERAGE_ATTEMPTS = CoalescedTask('reconcile-average-attempts',
+                                           '/crons/reconcile_average_attempts', method='GET')
 
 
 # - - - - GetYourBonusDayApi Endpoints - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -41,13 +64,16 @@ class GetYourBonusDayApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented('create_user')
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        user = None
+        if not get_user_keys([request.user_name])[request.user_name]:
+            user = User.insert(request.user_name, request.email)
+        if not user:
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        remember_user_key(user.key, user.name)
         return StringMessage(message='User {} created!'.format(
             request.user_name))
 
@@ -57,30 +83,41 @@ class GetYourBonusDayApi(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented('new_game')
+    @ndb.toplevel
     def new_game(self, request):
         """Creates new game"""
-        user = User.query(User.name == request.user_name).get()
+        user = yield get_user_async(request.user_name)
         # Validate user
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
 
-        # Check to see if game already exist.
-        if user.key and request.attempts:
-            games = Game.query(Game.user == user.key)
-            for game in games:
-                if game and game.attempts_allowed == request.attempts:
-                    game.key.delete()
+        # Look up existing games with the same number of attempts; they are
+        # replaced by the new game. The projection query is billed like a
+        # keys-only one and still tells which replaced games were unfinished.
+        duplicates = []
+        if request.attempts:
+            duplicates = Game.query(Game.user == user.key,
+                                    Game.attempts_allowed == request.attempts). \
+                fetch_async(projection=[Game.attempts_remaining, Game.game_over])
 
-        game = Game.new_game(user.key, request.attempts)
         user.attempts_allowed = request.attempts
-        user.put()
-
-        # Use a task queue to update the average attempts remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
-        return game.to_form('Good luck playing Get Your Bonus Day!')
+        game, _, duplicates = yield (Game.new_game_async(user.key, request.attempts, user.name),
+                                     user.put_async(), duplicates)
+
+        # Update the running aggregate behind get_average_attempts_remaining.
+        total, count = game.attempts_contribution()
+        stale_keys = []
+        for duplicate in duplicates:
+            if duplicate.key != game.key:
+                stale_keys.append(duplicate.key)
+                duplicate_total, duplicate_count = duplicate.attempts_contribution()
+                total -= duplicate_total
+                count -= duplicate_count
+        yield [self._adjust_aggregate_async(total, count)] + \
+            ndb.delete_multi_async(stale_keys)
+        raise ndb.Return(game.to_form('Good luck playing Get Your Bonus Day!', user.name))
 
     # - - - - Get game endpoint - - - - - - - - - - - - - - -
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -88,29 +125,38 @@ class GetYourBonusDayApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented('get_game')
+    @ndb.toplevel
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = yield get_by_urlsafe_async(request.urlsafe_game_key, Game, cached=True)
         if game:
-            return game.to_form('Time to make a move!')
+            form = yield game.to_form_async('Time to make a move!')
+            raise ndb.Return(form)
         else:
             raise endpoints.NotFoundException('Game not found!')
 
     # - - - - Get user game endpoint - - - - - - - - - - - - - - -
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=GameForms,
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented('get_user_games')
+    @ndb.toplevel
     def get_user_games(self, request):
         """Returns all of an individual User's games"""
-        user = User.query(User.name == request.user_name).get()
+        user = yield get_user_async(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
         games = Game.query(Game.user == user.key). \
             filter(Game.game_over == False)
-        return GameForms(items=[game.to_form('Time to make a move!') for game in games])
+        games, next_page_token = yield fetch_page_async(games, request.page_size, request.page_token)
+        forms = yield Game.to_forms_async(games, 'Time to make a move!',
+                                          names={user.key: user.name})
+        forms.next_page_token = next_page_token
+        raise ndb.Return(forms)
 
     # - - - - Make move endpoint - - - - - - - - - - - - - - -
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
@@ -118,120 +164,378 @@ class GetYourBonusDayApi(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT' or 'DELETE')
+    @instrumented('make_move')
+    @ndb.toplevel
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
 
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-
-        user = User.query(User.name == request.user_name).get()
+        # Fetch the game while the user name is resolved.
+        game, user_keys = yield (get_by_urlsafe_async(request.urlsafe_game_key, Game, cached=True),
+                                 get_user_keys_async([request.user_name]))
+        user_key = user_keys[request.user_name]
 
         # Validate user
-        if not user:
+        if not user_key:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
 
         # Validate game and player
-        if game and user.key == game.user:
-
-            user.attempts_allowed = game.attempts_allowed
-            user.put()
+        if not game or user_key != game.user:
+            raise endpoints.BadRequestException('User_name not found! Or game already over! Or something else...')
 
-            # Check to see if game is already finished
-            if game.game_over:
-                game.add_game_history('Game already over!', game.attempts_allowed - game.attempts_remaining)
-                user.game_over = True
-                user.put()
-                return game.to_form('Game already over!')
+        change, results = yield self._commit_moves_async(user_key, [(game.key, request.pick_a_date)])
+        yield self._adjust_aggregate_async(*change)
+        form, error = results[0]
+        if error:
+            raise endpoints.NotFoundException(error)
+        raise ndb.Return(form)
 
-            # Check to see if valid guess
-            if request.pick_a_date > 31 or request.pick_a_date < 1:
-                game.add_game_history('Invalid guess! No such date!', game.attempts_allowed - game.attempts_remaining)
-                return game.to_form('Invalid guess! No such date!')
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _commit_moves_async(user_key, moves):
+        """Applies a User's moves, in order, to freshly read copies of their
+        Games and the User, then commits them together with any resulting
+        Scores and the UserStats in a single put_multi. moves are (game key,
+        pick_a_date) pairs over at most MAX_GAMES_PER_COMMIT Games. Returns
+        the (total, count) change the caller applies to the running aggregate
+        and, per move, the GameForm after it and None, or None and an error."""
+        game_keys = list(set(game_key for game_key, _ in moves))
+        stats_key = UserStats.key_for(user_key)
+        entities = yield ndb.get_multi_async(game_keys + [user_key, stats_key])
+        games = dict(zip(game_keys, entities))
+        user = entities[-2]
+        stats = entities[-1] or UserStats(key=stats_key)
+        results = []
+        scores = []
+        total, count = 0, 0
+        for game_key, pick_a_date in moves:
+            game = games[game_key]
+            if not game:
+                results.append((None, 'Game not found!'))
+                continue
+            before = game.attempts_contribution()
+            msg, score = yield GetYourBonusDayApi._play_move_async(game, user, pick_a_date, stats)
+            after = game.attempts_contribution()
+            total += after[0] - before[0]
+            count += after[1] - before[1]
+            if score:
+                scores.append(score)
+            form = yield game.to_form_async(msg, user.name)
+            results.append((form, None))
+
+        played = [game for game in games.values() if game]
+        if played:
+            yield ndb.put_multi_async(played + [user] + scores + ([stats] if scores else []))
+        raise ndb.Return(((total, count), results))
 
+    @staticmethod
+    @ndb.tasklet
+    def _adjust_aggregate_async(total, count):
+        """Applies a change to the running aggregate once the write that
+        caused it has committed, so that the shards never join a move's
+        transaction. A failed update only leaves drift for the reconcile cron
+        to correct, so it does not fail the request."""
+        if not total and not count:
+            return
+        try:
+            yield AttemptsRemainingShard.adjust_async(total, count)
+        except datastore_errors.Error:
+            logging.warning('Running aggregate update of (%s, %s) failed', total, count, exc_info=True)
+
+    # - - - - Make moves endpoint - - - - - - - - - - - - - - -
+    @endpoints.method(request_message=MakeMovesForm,
+                      response_message=GameForms,
+                      path='games/moves',
+                      name='make_moves',
+                      http_method='POST')
+    @instrumented('make_moves')
+    def make_moves(self, request):
+        """Makes a batch of moves, possibly across many games. Returns the game
+        state after each applied move and an error for each rejected one."""
+        if len(request.moves) > MAX_BATCH_MOVES:
+            raise endpoints.BadRequestException(
+                'At most {} moves per batch!'.format(MAX_BATCH_MOVES))
+
+        user_keys = get_user_keys(move.user_name for move in request.moves)
+        game_keys = {}
+        for move in request.moves:
+            try:
+                key = parse_urlsafe(move.urlsafe_game_key)
+            except endpoints.BadRequestException:
+                continue
+            if key.kind() == Game._get_kind():
+                game_keys[move.urlsafe_game_key] = key
+
+        # Validate every move against one batched get of the games; each
+        # commit reads them again in its transaction.
+        keys = list(set(game_keys.values()))
+        games = dict(zip(keys, ndb.get_multi(keys)))
+
+        errors = []
+        moves_by_user = collections.OrderedDict()
+        for index, move in enumerate(request.moves):
+            game_key = game_keys.get(move.urlsafe_game_key)
+            user_key = user_keys[move.user_name]
+            game = games.get(game_key)
+            if not user_key:
+                error = 'A User with that name does not exist!'
+            elif not game_key:
+                error = 'Invalid Key'
+            elif not game:
+                error = 'Game not found!'
+            elif user_key != game.user:
+                error = 'User_name not found! Or game already over! Or something else...'
             else:
-                game.attempts_remaining -= 1
-                # If the dates match, user win.
-                if request.pick_a_date == game.target:
-                    user.num_of_wons += 1
-                    user.game_over = True
-                    user.put()
-                    game.num_of_wons = user.num_of_wons
-                    game.won = True
-                    game.add_game_history('Congratulations! You picked the correct date.',
-                                          game.attempts_allowed - game.attempts_remaining)
-                    game.end_game(game.won, game.num_of_wons)
-                    game.put()
-                    return game.to_form('You win!')
-
-                # If guess is incorrect, warn user and try again
-                if request.pick_a_date < game.target:
-                    msg = 'Maybe too early for a bonus!'
-                    game.add_game_history('You guessed higher.', game.attempts_allowed - game.attempts_remaining)
-                else:
-                    msg = 'A little too late, a bonus comes sooner than that!'
-                    game.add_game_history('You guessed lower.', game.attempts_allowed - game.attempts_remaining)
-
-                # User guesses incorrectly and exceeded limited attempts, so game over  
-                if game.attempts_remaining < 1:
-                    user.num_of_wons == user.num_of_wons
-                    user.game_over = True
-                    user.put()
-                    game.won = False
-                    game.num_of_wons = user.num_of_wons
-                    game.add_game_history('Incorrect. Game over!', game.attempts_allowed - game.attempts_remaining)
-                    game.end_game(game.won, game.num_of_wons)
-
-
-                game.put()
-                return game.to_form(msg + ' Game over!')
-
-        raise endpoints.BadRequestException('User_name not found! Or game already over! Or something else...')
+                moves_by_user.setdefault(user_key, []).append((index, game_key, move.pick_a_date))
+                continue
+            errors.append(MoveErrorForm(index=index, message=error,
+                                        urlsafe_game_key=move.urlsafe_game_key))
+
+        # Each commit is one transaction over one User's moves on at most
+        # MAX_GAMES_PER_COMMIT of their Games. Commits run one at a time, so
+        # the leaderboard tasks a commit enqueues join that transaction. A
+        # failed commit rejects only its own moves.
+        forms = {}
+        total, count = 0, 0
+        for user_key, moves in moves_by_user.items():
+            for chunk in self._chunk_by_game(moves):
+                try:
+                    change, results = self._commit_moves_async(
+                        user_key, [(game_key, pick_a_date) for _, game_key, pick_a_date in chunk]).get_result()
+                except (datastore_errors.Error, taskqueue.Error):
+                    logging.warning('make_moves commit of %s moves failed', len(chunk), exc_info=True)
+                    errors.extend(MoveErrorForm(index=index, message=COMMIT_FAILED,
+                                                urlsafe_game_key=request.moves[index].urlsafe_game_key)
+                                  for index, _, _ in chunk)
+                    continue
+                total += change[0]
+                count += change[1]
+                for (index, _, _), (form, error) in zip(chunk, results):
+                    if error:
+                        errors.append(MoveErrorForm(index=index, message=error,
+                                                    urlsafe_game_key=request.moves[index].urlsafe_game_key))
+                    else:
+                        forms[index] = form
+        self._adjust_aggregate_async(total, count).get_result()
+        return GameForms(items=[forms[index] for index in sorted(forms)],
+                         errors=sorted(errors, key=lambda error: error.index))
+
+    @staticmethod
+    def _chunk_by_game(moves):
+        """Splits (index, game key, pick_a_date) moves into chunks holding
+        every move of at most MAX_GAMES_PER_COMMIT Games, in request order"""
+        game_keys = []
+        for _, game_key, _ in moves:
+            if game_key not in game_keys:
+                game_keys.append(game_key)
+        for start in range(0, len(game_keys), MAX_GAMES_PER_COMMIT):
+            chunk = set(game_keys[start:start + MAX_GAMES_PER_COMMIT])
+            yield [move for move in moves if move[1] in chunk]
+
+    @staticmethod
+    @ndb.tasklet
+    def _play_move_async(game, user, pick_a_date, stats):
+        """Applies a guess to the Game and User in memory without writing
+        anything. Returns the response message and the Score to store if the
+        game ended, otherwise None; an ended game is also folded into the
+        User's stats."""
+        user.attempts_allowed = game.attempts_allowed
+        if game.user_name is None:
+            game.user_name = user.name
+
+        # Check to see if game is already finished
+        if game.game_over:
+            game.add_game_history('Game already over!', game.attempts_allowed - game.attempts_remaining)
+            user.game_over = True
+            raise ndb.Return(('Game already over!', None))
+
+        # Check to see if valid guess
+        if pick_a_date > 31 or pick_a_date < 1:
+            game.add_game_history('Invalid guess! No such date!', game.attempts_allowed - game.attempts_remaining)
+            raise ndb.Return(('Invalid guess! No such date!', None))
+
+        # Only a valid guess is activity that keeps the game from expiring.
+        game.last_activity = datetime.datetime.utcnow()
+        game.attempts_remaining -= 1
+        # If the dates match, user win.
+        if pick_a_date == game.target:
+            user.num_of_wons += 1
+            user.game_over = True
+            game.num_of_wons = user.num_of_wons
+            game.won = True
+            game.add_game_history('Congratulations! You picked the correct date.',
+                                  game.attempts_allowed - game.attempts_remaining)
+            score = yield game.end_game_async(game.won, game.num_of_wons, stats)
+            raise ndb.Return(('You win!', score))
+
+        # If guess is incorrect, warn user and try again
+        if pick_a_date < game.target:
+            msg = 'Maybe too early for a bonus!'
+            game.add_game_history('You guessed higher.', game.attempts_allowed - game.attempts_remaining)
+        else:
+            msg = 'A little too late, a bonus comes sooner than that!'
+            game.add_game_history('You guessed lower.', game.attempts_allowed - game.attempts_remaining)
+
+        # User guesses incorrectly and exceeded limited attempts, so game over
+        score = None
+        if game.attempts_remaining < 1:
+            user.game_over = True
+            game.won = False
+            game.num_of_wons = user.num_of_wons
+            game.add_game_history('Incorrect. Game over!', game.attempts_allowed - game.attempts_remaining)
+            score = yield game.end_game_async(game.won, game.num_of_wons, stats)
+
+        raise ndb.Return((msg + ' Game over!', score))
 
     # - - - - Cancel game endpoint - - - - - - - - - - - - - - -
     @endpoints.method(request_message=GET_GAME_REQUEST, response_message=StringMessage,
                       path='game/{urlsafe_game_key}/cancel',
                       http_method='DELETE', name='cancel_game')
+    @instrumented('cancel_game')
+    @ndb.toplevel
     def cancel_game(self, request):
         """Cancel an active game."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = yield get_by_urlsafe_async(request.urlsafe_game_key, Game, cached=True)
 
+        deleted = False
         if game and not game.game_over:
-            game.canceled_game()
-            game.key.delete()
-            return StringMessage(message='Game with key: {} deleted.'.
-                                 format(request.urlsafe_game_key))
+            deleted, change = yield self._delete_game_async(game.key)
+            yield self._adjust_aggregate_async(*change)
+        if deleted:
+            raise ndb.Return(StringMessage(message='Game with key: {} deleted.'.
+                                           format(request.urlsafe_game_key)))
 
-        elif game and game.game_over:
+        elif game:
             raise endpoints.BadRequestException(
                 'Cannot cancel a completed game!')
         else:
             raise endpoints.NotFoundException('That game does not exist!')
 
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _delete_game_async(game_key):
+        """Deletes an unfinished Game. Returns False if the Game has finished
+        in the meantime, otherwise True, and the change to the running
+        aggregate."""
+        game = yield game_key.get_async()
+        if game and game.game_over:
+            raise ndb.Return((False, (0, 0)))
+        total, count = 0, 0
+        if game:
+            game.canceled_game()
+            total, count = game.attempts_contribution()
+            yield game_key.delete_async()
+        raise ndb.Return((True, (-total, -count)))
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _expire_game_async(game_key, idle_since):
+        """Ends an unfinished Game without moves since idle_since as lost,
+        storing its Score and the User's stats as a losing final move would.
+        Returns the change the caller applies to the running aggregate, or
+        None if the Game was played or finished in the meantime."""
+        game = yield game_key.get_async()
+        if not game or game.game_over or not game.last_activity or game.last_activity >= idle_since:
+            raise ndb.Return(None)
+        stats_key = UserStats.key_for(game.user)
+        user, stats = yield ndb.get_multi_async([game.user, stats_key])
+        before = game.attempts_contribution()
+        game.won = False
+        if user:
+            user.game_over = True
+            game.num_of_wons = user.num_of_wons
+            if game.user_name is None:
+                game.user_name = user.name
+            stats = stats or UserStats(key=stats_key)
+        game.add_game_history('Game expired after inactivity.', game.attempts_allowed - game.attempts_remaining)
+        score = yield game.end_game_async(game.won, game.num_of_wons, stats)
+        after = game.attempts_contribution()
+        yield ndb.put_multi_async([entity for entity in (game, user, score, stats) if entity])
+        raise ndb.Return((after[0] - before[0], after[1] - before[1]))
+
     # - - - - Get scores endpoint - - - - - - - - - - - - - - -
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented('get_scores')
+    @ndb.toplevel
     def get_scores(self, request):
-        """Return all scores"""
-        scores = Score.query().order(Score.user)
-
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Return all scores, those since the retention window in key order
+        and then the archived ones by day"""
+        forms = yield self._page_scores(Score.query(),
+                                        ScoreArchive.query().order(ScoreArchive.date),
+                                        lambda archive: archive.rows, request)
+        raise ndb.Return(forms)
 
     # - - - - Get user scores endpoint - - - - - - - - - - - - - - -
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented('get_user_scores')
+    @ndb.toplevel
     def get_user_scores(self, request):
         """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        user = yield get_user_async(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        scores = Score.query(Score.user == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        forms = yield self._page_scores(Score.query(Score.user == user.key),
+                                        UserScoreArchive.query(ancestor=user.key),
+                                        lambda archive: archive.entries(), request,
+                                        names={user.key: user.name})
+        raise ndb.Return(forms)
+
+    @staticmethod
+    @ndb.tasklet
+    def _page_scores(scores, archives, rows_of, request, names=None):
+        """Returns a page of the stored Scores of a query and, once they run
+        out, of the archived Scores held by the entities of a second query"""
+        page_token = request.page_token
+        if page_token and page_token.startswith(ARCHIVE_PAGE_TOKEN):
+            rows, next_page_token = fetch_rows_page(archives, rows_of, request.page_size,
+                                                    page_token[len(ARCHIVE_PAGE_TOKEN):])
+            forms = Leaderboard.to_forms(rows)
+            if next_page_token:
+                forms.next_page_token = ARCHIVE_PAGE_TOKEN + next_page_token
+            raise ndb.Return(forms)
+
+        scores, next_page_token = yield fetch_page_async(scores, request.page_size, page_token)
+        if not next_page_token:
+            archived = yield archives.get_async(keys_only=True)
+            if archived:
+                next_page_token = ARCHIVE_PAGE_TOKEN
+        forms = yield Score.to_forms_async(scores, names)
+        forms.next_page_token = next_page_token
+        raise ndb.Return(forms)
+
+    # - - - - Get user stats endpoint - - - - - - - - - - - - - - -
+    @endpoints.method(request_message=USER_NAME_REQUEST,
+                      response_message=UserStatsForm,
+                      path='user/{user_name}/stats',
+                      name='get_user_stats',
+                      http_method='GET')
+    @instrumented('get_user_stats')
+    @ndb.toplevel
+    def get_user_stats(self, request):
+        """Returns an individual User's rollup of finished games"""
+        user_keys = yield get_user_keys_async([request.user_name])
+        user_key = user_keys[request.user_name]
+        if not user_key:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        stats_key = UserStats.key_for(user_key)
+        stats = yield stats_key.get_async()
+        if not stats or not stats.seeded:
+            # The backfill has not reached this User; count their Scores.
+            stats = stats or UserStats(key=stats_key)
+            scores = yield Score.query(Score.user == user_key). \
+                fetch_async(projection=[Score.won, Score.guesses])
+            stats.add_unrecorded(scores)
+        raise ndb.Return(stats.to_form(request.user_name))
 
     # - - - - Get high scores endpoint - - - - - - - - - - - - - - -
     @endpoints.method(request_message=LimitResults,
@@ -239,26 +543,38 @@ class GetYourBonusDayApi(remote.Service):
                       path='scores/high_scores',
                       name='get_high_scores',
                       http_method='GET')
+    @instrumented('get_high_scores')
     def get_high_scores(self, request):
-        """Return all scores ordered by total points"""
-        if request.limit:
-            scores = Score.query().order(-Score.num_of_wons).fetch(request.limit)
-
-        else:
-            scores = Score.query().order(-Score.num_of_wons).fetch()
-
-        return ScoreForms(items=[score.to_form() for score in scores])
+        """Return the highest scores ordered by total points"""
+        if request.limit is not None and request.limit < 1:
+            raise endpoints.BadRequestException('limit must be positive')
+        board = self._leaderboard()
+        return Leaderboard.to_forms(board.high_scores[:request.limit or LEADERBOARD_SIZE])
 
     # - - - - Get user rankings endpoint - - - - - - - - - - - - - - -
-    @endpoints.method(response_message=ScoreForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores/user_rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented('get_user_rankings')
     def get_user_rankings(self, request):
-        """Return all scores ordered by numbers of won"""
-        scores = Score.query().filter(Score.won == True).order(-Score.num_of_wons)
+        """Return the top winning scores ordered by numbers of won"""
+        rankings, next_page_token = page_list(self._leaderboard().rankings,
+                                              request.page_size, request.page_token)
+        forms = Leaderboard.to_forms(rankings)
+        forms.next_page_token = next_page_token
+        return forms
 
-        return ScoreForms(items=[score.to_form() for score in scores])
+    @staticmethod
+    def _leaderboard():
+        """Returns the materialized Leaderboard. If it has not been built yet,
+        schedules the build and computes an unsaved one for this request."""
+        board = Leaderboard.load()
+        if not board:
+            REBUILD_LEADERBOARD.trigger()
+            board = Leaderboard.build()
+        return board
 
     # - - - - Get game history endpoint - - - - - - - - - - - - - - -
     @endpoints.method(request_message=GET_GAME_REQUEST,
@@ -266,34 +582,46 @@ class GetYourBonusDayApi(remote.Service):
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented('get_game_history')
+    @ndb.toplevel
     def get_game_history(self, request):
         """Returns a summary of a game's guesses."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = yield get_by_urlsafe_async(request.urlsafe_game_key, Game, cached=True)
         if not game:
             raise endpoints.NotFoundException('Game not found')
 
-        return StringMessage(message=str(game.history))
+        raise ndb.Return(StringMessage(message=str(game.get_history())))
 
     # - - - - Get average attempts remaining endpoint - - - - - - - - - - - - - - -
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @instrumented('get_average_attempts_remaining')
     def get_average_attempts(self, request):
-        """Get the cached average moves remaining"""
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING) or '')
+        """Get the average moves remaining from the running aggregate"""
+        total, count = AttemptsRemainingShard.totals()
+        if count < 0 or total < 0:
+            # The shards have drifted; have them recomputed.
+            RECONCILE_AVERAGE_ATTEMPTS.trigger()
+        if count <= 0:
+            return StringMessage(message='')
+        return StringMessage(message='The average moves remaining is {:.2f}'.format(
+            float(total) / count))
 
     @staticmethod
-    def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining
-                                            for game in games])
-            average = float(total_attempts_remaining) / count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(average))
+    def _reconcile_average_attempts():
+        """Recomputes the running aggregate of attempts remaining from the
+        unfinished Games, correcting any drift in the shards. The shards are
+        read before the scan and corrected by the difference rather than
+        overwritten, so updates committed during the scan are kept."""
+        baseline_total, baseline_count = AttemptsRemainingShard.totals()
+        games = Game.query(Game.game_over == False)
+        total, count = 0, 0
+        for game in games.iter(projection=[Game.attempts_remaining], batch_size=1000):
+            total += game.attempts_remaining
+            count += 1
+        AttemptsRemainingShard.adjust(total - baseline_total, count - baseline_count)
 
 
 api = endpoints.api_server([GetYourBonusDayApi])
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Load generation and benchmarks for the Game API.
+
+Simulates many players against the App Engine testbed datastore, memcache and
+taskqueue stubs. Every player runs a scripted session of create_user, new_game,
+make_move until the game ends, and the score and leaderboard endpoints. For each
+endpoint, latency percentiles and the datastore RPCs and entity writes it issued
+are written to a JSON file, with the calls per second of wall-clock time over the
+whole run, so runs can be compared:
+
+    python benchmark.py --players 2000 --output after.json --baseline before.json
+
+With --analytics-rows, it instead measures how the export chunk format and
+analytics.py scale over synthetic Scores of each given size:
+
+    python benchmark.py --analytics-rows 100000,1000000,10000000
+
+Requires the App Engine SDK on sys.path (or importable dev_appserver), and
+NumPy for --analytics-rows."""
+
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+from protorpc import message_types
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+DATASTORE_READS = ('Get', 'RunQuery', 'Next')
+
+
+class EndpointStats(object):
+    """Latency samples and datastore usage of one endpoint"""
+
+    def __init__(self):
+        self.latencies = []
+        self.rpcs = collections.Counter()
+        self.writes = 0
+
+    def record(self, latency, rpcs, writes):
+        self.latencies.append(latency)
+        self.rpcs.update(rpcs)
+        self.writes += writes
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        calls = len(latencies)
+        total = sum(latencies)
+        return {
+            'calls': calls,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'mean_ms': total / calls * 1000 if calls else 0.0,
+            'datastore_rpcs': dict(self.rpcs),
+            'datastore_rpcs_per_call': float(sum(self.rpcs.values())) / calls,
+            'datastore_reads_per_call': float(sum(self.rpcs[call] for call in DATASTORE_READS)) / calls,
+            'entity_writes_per_call': float(self.writes) / calls,
+        }
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    rank = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class Benchmark(object):
+    """Drives the API service directly, the way the endpoints frontend would,
+    and runs queued tasks through the main.py handlers."""
+
+    def __init__(self, seed):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_mail_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+
+        # Imported once the stubs exist.
+        from instrumentation import RpcCounter
+        import api
+        import main
+        self.counter = RpcCounter()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'benchmark', self.counter, 'datastore_v3')
+        self.api = api
+        self.main = main
+        self.service = api.GetYourBonusDayApi()
+        self.random = random.Random(seed)
+        self.stats = collections.defaultdict(EndpointStats)
+
+    def close(self):
+        self.testbed.deactivate()
+
+    def call(self, name, container, **fields):
+        """Invokes an endpoint as its own request and records its cost"""
+        request = getattr(container, 'combined_message_class', container)(**fields)
+        ndb.get_context().clear_cache()
+        calls, writes = self.counter.snapshot()
+        start = time.time()
+        try:
+            return getattr(self.service, name)(request)
+        finally:
+            latency = time.time() - start
+            after_calls, after_writes = self.counter.snapshot()
+            self.stats[name].record(
+                latency,
+                dict((call, count - calls.get(call, 0)) for call, count in after_calls.items()),
+                after_writes - writes)
+
+    def run_tasks(self):
+        """Runs queued tasks, including any they enqueue, until the queues
+        are empty"""
+        import webapp2
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks()
+            if not tasks:
+                return
+            for task in tasks:
+                self.taskqueue.DeleteTask(task.queue_name or 'default', task.name)
+                request = webapp2.Request.blank(task.url, method=task.method,
+                                                body=task.payload, headers=task.headers)
+                ndb.get_context().clear_cache()
+                request.get_response(self.main.app)
+
+    def play(self, player):
+        """Scripted session of one player. Guesses are a binary search, with
+        an occasional random guess."""
+        api = self.api
+        user_name = 'player-{}'.format(player)
+        self.call('create_user', api.USER_REQUEST, user_name=user_name,
+                  email='{}@example.com'.format(user_name))
+        game = self.call('new_game', api.NEW_GAME_REQUEST, user_name=user_name,
+                         attempts=self.random.randint(3, 8))
+        low, high = 1, 31
+        while not game.game_over:
+            guess = (low + high) // 2 if self.random.random() < 0.8 else self.random.randint(1, 31)
+            game = self.call('make_move', api.MAKE_MOVE_REQUEST, user_name=user_name,
+                             urlsafe_game_key=game.urlsafe_key, pick_a_date=guess)
+            if 'early' in game.message:
+                low = max(low, guess + 1)
+            elif 'late' in game.message:
+                high = min(high, guess - 1)
+            low, high = min(low, high), max(low, high)
+
+        self.call('get_game', api.GET_GAME_REQUEST, urlsafe_game_key=game.urlsafe_key)
+        self.call('get_user_scores', api.USER_PAGE_REQUEST, user_name=user_name)
+        self.call('get_user_stats', api.USER_NAME_REQUEST, user_name=user_name)
+        self.call('get_high_scores', api.LimitResults, limit=10)
+        self.call('get_user_rankings', api.PAGE_REQUEST)
+        self.call('get_scores', api.PAGE_REQUEST)
+        self.call('get_average_attempts', message_types.VoidMessage)
+
+    def run(self, players, task_interval):
+        start = time.time()
+        for player in range(players):
+            self.play(player)
+            if (player + 1) % task_interval == 0:
+                self.run_tasks()
+        self.run_tasks()
+        return time.time() - start
+
+
+def benchmark_analytics(sizes, seed):
+    """Writes synthetic Scores of each size as export chunks and runs the
+    analytics over them. Returns the time and rows per second of each stage."""
+    import numpy
+    import analytics
+    import export
+    generator = numpy.random.RandomState(seed)
+    today = date.today().toordinal()
+    results = {}
+    for size in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            writer = export.ChunkWriter(directory, 'scores', export.SCORE_COLUMNS)
+            start = time.time()
+            for offset in range(0, size, export.CHUNK_ROWS):
+                rows = min(export.CHUNK_ROWS, size - offset)
+                attempts = generator.randint(3, 9, rows)
+                writer.write_columns([
+                    numpy.arange(offset, offset + rows),
+                    today - generator.randint(0, 365, rows),
+                    generator.randint(0, 2, rows),
+                    generator.randint(0, attempts + 1),
+                    generator.randint(0, 50, rows),
+                    numpy.where(generator.random_sample(rows) < 0.1, -1, attempts),
+                    numpy.array([u'player'] * rows)])
+            write_s = time.time() - start
+
+            start = time.time()
+            report = analytics.analyze(directory)
+            analyze_s = time.time() - start
+            assert report['scores'] == size
+        finally:
+            shutil.rmtree(directory)
+        results[str(size)] = {'chunks': writer.chunks,
+                              'write_s': write_s, 'write_rows_per_s': size / write_s,
+                              'analyze_s': analyze_s, 'analyze_rows_per_s': size / analyze_s}
+        print '{:>10} rows  write {:>7.2f}s ({:>10.0f} rows/s)  analyze {:>7.2f}s ({:>10.0f} rows/s)'.format(
+            size, write_s, size / write_s, analyze_s, size / analyze_s)
+    return results
+
+
+def compare(results, baseline):
+    """Prints the change of each endpoint's figures against a baseline run"""
+    for name, summary in sorted(results['endpoints'].items()):
+        before = baseline['endpoints'].get(name)
+        if not before:
+            continue
+        print '{:<26} p50 {:>8.2f}ms ({:+.0%})  p99 {:>8.2f}ms ({:+.0%})  rpcs/call {:>6.2f} ({:+.2f})'.format(
+            name,
+            summary['p50_ms'], summary['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0,
+            summary['p99_ms'], summary['p99_ms'] / before['p99_ms'] - 1 if before['p99_ms'] else 0,
+            summary['datastore_rpcs_per_call'],
+            summary['datastore_rpcs_per_call'] - before['datastore_rpcs_per_call'])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--task-interval', type=int, default=50,
+                        help='run queued tasks after this many players')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', help='results file of an earlier run to compare with')
+    parser.add_argument('--analytics-rows',
+                        help='comma separated Score counts to benchmark the export and analytics with')
+    args = parser.parse_args(argv)
+
+    if args.analytics_rows:
+        results = {'seed': args.seed,
+                   'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'analytics': benchmark_analytics([int(size) for size in args.analytics_rows.split(',')],
+                                                    args.seed)}
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        return
+
+    benchmark = Benchmark(args.seed)
+    try:
+        duration = benchmark.run(args.players, args.task_interval)
+    finally:
+        benchmark.close()
+
+    results = {
+        'players': args.players,
+        'seed': args.seed,
+        'duration_s': duration,
+        'calls_per_s': sum(len(stats.latencies) for stats in benchmark.stats.values()) / duration,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'endpoints': dict((name, stats.summary()) for name, stats in benchmark.stats.items()),
+    }
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    print 'Simulated {} players in {:.1f}s ({:.1f} calls/s); results written to {}'.format(
+        args.players, duration, results['calls_per_s'], args.output)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+"""cache.py - In-process caching shared by the models and the API helpers."""
+
+import threading
+import time
+from collections import OrderedDict
+from google.appengine.ext import ndb
+
+ENTITY_CACHE_SIZE = 2000
+# Seconds an entity is served from this instance before ndb is asked again.
+# Puts and deletes on other instances become visible after this.
+ENTITY_CACHE_TTL = 2
+
+
+class LRUCache(object):
+    """A bounded, thread-safe, in-process cache that evicts the least
+    recently used entry once capacity is reached."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def replace(self, key, expected, value):
+        """Sets key to value only if its entry is still the expected object,
+        or still absent if expected is None. Returns True if it was set."""
+        with self._lock:
+            if self._items.get(key) is not expected:
+                return False
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+
+_entities = LRUCache(ENTITY_CACHE_SIZE)
+
+
+def get_cached_entity(key):
+    """Returns the entity for key; see get_cached_entity_async"""
+    return get_cached_entity_async(key).get_result()
+
+
+@ndb.tasklet
+def get_cached_entity_async(key):
+    """Returns the entity for key, or None if it does not exist. Reads go to
+    a short-lived in-process cache, which also remembers missing entities,
+    then to ndb, whose own memcache caching guards against stale fills."""
+    now = time.time()
+    cached = _entities.get(key)
+    if cached and cached[0] > now:
+        raise ndb.Return(cached[1])
+
+    entity = yield key.get_async()
+    # A put or delete that committed during the get has replaced the entry,
+    # so the result is only cached if the entry is unchanged.
+    _entities.replace(key, cached, (now + ENTITY_CACHE_TTL, entity))
+    raise ndb.Return(entity)
+
+
+def _invalidate(key, deleted):
+    # A fresh entry, even an expired one, tells reads in flight that their
+    # result is stale.
+    if deleted:
+        _entities.set(key, (time.time() + ENTITY_CACHE_TTL, None))
+    else:
+        _entities.set(key, (0, None))
+
+
+class CachedModel(ndb.Model):
+    """Base for models readable through get_cached_entity. Every put and
+    delete invalidates the cached copy once it has committed."""
+
+    def _post_put_hook(self, future):
+        key = self.key
+        ndb.get_context().call_on_commit(lambda: _invalidate(key, False))
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        ndb.get_context().call_on_commit(lambda: _invalidate(key, True))
@@ -0,0 +1,68 @@
+"""coalesce.py - Coalesced, debounced enqueueing of background tasks.
+
+A CoalescedTask is triggered whenever its work becomes due. Triggers that land
+in the same time window collapse into a single named task, which runs at the end
+of the window. A memcache flag per window lets every trigger after the first
+skip the taskqueue call, and the task name keeps the window to one task even if
+the flag is evicted. Trigger and enqueue counts are kept in memcache so the
+number of absorbed triggers can be reported."""
+
+import os
+import time
+
+from google.appengine.api import memcache, taskqueue
+
+# Default coalescing window in seconds, set in app.yaml.
+DEFAULT_WINDOW = int(os.environ.get('TASK_COALESCE_WINDOW_SECONDS', '60'))
+MEMCACHE_COALESCE_PENDING = 'COALESCE_PENDING:{}:{}'
+MEMCACHE_COALESCE = 'COALESCE:{}:{}'
+COUNTERS = ('triggers', 'enqueued')
+
+_coalesced_tasks = []
+
+
+class CoalescedTask(object):
+    """A task that runs at most once per window however often it is
+    triggered. Named tasks cannot be transactional, so trigger it outside
+    of transactions."""
+
+    def __init__(self, name, url, window=None, method='POST'):
+        self.name = name
+        self.url = url
+        self.window = window or DEFAULT_WINDOW
+        self.method = method
+        _coalesced_tasks.append(self)
+
+    def trigger(self, params=None):
+        """Schedules the task for the end of the current window unless it
+        already is. Returns True if this trigger enqueued it."""
+        now = time.time()
+        bucket = int(now // self.window)
+        enqueued = 0
+        if memcache.add(MEMCACHE_COALESCE_PENDING.format(self.name, bucket), 1, time=self.window * 2):
+            try:
+                taskqueue.add(url=self.url, method=self.method, params=params,
+                              name='coalesce-{}-{}-{}'.format(self.name, self.window, bucket),
+                              countdown=max(int((bucket + 1) * self.window - now), 0))
+                enqueued = 1
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                pass
+        memcache.offset_multi({MEMCACHE_COALESCE.format(self.name, 'triggers'): 1,
+                               MEMCACHE_COALESCE.format(self.name, 'enqueued'): enqueued},
+                              initial_value=0)
+        return bool(enqueued)
+
+
+def get_stats():
+    """Returns the triggers, enqueued tasks and absorbed triggers of every
+    coalesced task since the counters were last evicted"""
+    values = memcache.get_multi([MEMCACHE_COALESCE.format(task.name, counter)
+                                 for task in _coalesced_tasks for counter in COUNTERS])
+    stats = {}
+    for task in _coalesced_tasks:
+        totals = dict((counter, int(values.get(MEMCACHE_COALESCE.format(task.name, counter), 0)))
+                      for counter in COUNTERS)
+        totals['absorbed'] = totals['triggers'] - totals['enqueued']
+        totals['window_s'] = task.window
+        stats[task.name] = totals
+    return stats
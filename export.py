@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""export.py - Streaming columnar export of Scores and Games.
+
+Pages through the Score, ScoreArchive and Game kinds with query cursors and
+writes their rows in chunk files of CHUNK_ROWS rows, so memory is bounded by
+the chunk size whatever the number of entities:
+
+    python export.py --server my-app.appspot.com --output export/
+
+A chunk holds one array per column: a compressed NumPy .npz file, or a CSV
+file when NumPy is not installed or --format csv is given. analytics.py reads
+either. Requires the App Engine SDK on sys.path (or importable dev_appserver)
+and the remote_api builtin enabled in app.yaml."""
+
+import argparse
+import calendar
+import csv
+import os
+import sys
+from datetime import datetime
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EXPORT_BATCH_SIZE = 1000
+CHUNK_ROWS = 100000
+# Columns of each exported kind with their NumPy types. Missing values are -1.
+# Names come last, as only they can hold the CSV delimiter.
+SCORE_COLUMNS = (('game_id', 'int64'), ('date', 'int32'), ('won', 'int8'), ('guesses', 'int32'),
+                 ('num_of_wons', 'int32'), ('attempts_allowed', 'int32'), ('user_name', 'unicode'))
+GAME_COLUMNS = (('game_id', 'int64'), ('attempts_allowed', 'int32'), ('attempts_remaining', 'int32'),
+                ('game_over', 'int8'), ('won', 'int8'), ('last_activity', 'int64'), ('user_name', 'unicode'))
+
+
+class ChunkWriter(object):
+    """Writes one kind's rows as numbered chunk files named
+    <kind>-<number>.npz or .csv"""
+
+    def __init__(self, directory, kind, columns, format='npz', chunk_rows=CHUNK_ROWS):
+        if format == 'npz' and numpy is None:
+            format = 'csv'
+        self.directory = directory
+        self.kind = kind
+        self.columns = columns
+        self.format = format
+        self.chunk_rows = chunk_rows
+        self.buffer = []
+        self.chunks = 0
+        self.rows = 0
+
+    def write(self, rows):
+        """Buffers row tuples, in column order, and writes a chunk whenever
+        chunk_rows are buffered"""
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered rows as a chunk"""
+        if self.buffer:
+            self.write_columns(zip(*self.buffer))
+            self.buffer = []
+
+    def write_columns(self, values):
+        """Writes one sequence per column, in column order, as the next chunk"""
+        path = os.path.join(self.directory, '{}-{:05d}.{}'.format(self.kind, self.chunks, self.format))
+        if self.format == 'npz':
+            numpy.savez_compressed(path, **dict(
+                (name, numpy.array(column, dtype=dtype if dtype != 'unicode' else None))
+                for (name, dtype), column in zip(self.columns, values)))
+        else:
+            with open(path, 'wb') as output:
+                writer = csv.writer(output)
+                writer.writerow([name for name, _ in self.columns])
+                for row in zip(*values):
+                    writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value
+                                     for value in row])
+        self.chunks += 1
+        self.rows += len(values[0])
+
+
+def _game_id(score_id):
+    """Scores are keyed by the id of their Game; older ones have ids of their own"""
+    return int(score_id) if isinstance(score_id, basestring) and score_id.isdigit() else -1
+
+
+def _missing(value):
+    return -1 if value is None else value
+
+
+def score_row(score):
+    return (_game_id(score.key.id()), score.date.toordinal(), int(score.won), score.guesses,
+            score.num_of_wons, _missing(score.attempts_allowed), score.user_name or u'')
+
+
+def archived_score_row(entry):
+    """Row of a Score archived as a Leaderboard entry in a ScoreArchive"""
+    return (_game_id(entry['id']), datetime.strptime(entry['date'], '%Y-%m-%d').toordinal(), int(entry['won']),
+            entry['guesses'], entry['num_of_wons'], _missing(entry.get('attempts_allowed')),
+            entry['user_name'] or u'')
+
+
+def game_row(game):
+    last_activity = calendar.timegm(game.last_activity.utctimetuple()) if game.last_activity else -1
+    return (game.key.id(), game.attempts_allowed, game.attempts_remaining, int(game.game_over),
+            int(game.won), last_activity, game.user_name or u'')
+
+
+def export(query, to_rows, writer):
+    """Streams the entities of a query, a batch per cursor page, into chunks"""
+    cursor = None
+    more = True
+    while more:
+        entities, cursor, more = query.fetch_page(EXPORT_BATCH_SIZE, start_cursor=cursor)
+        rows = []
+        for entity in entities:
+            rows.extend(to_rows(entity))
+        writer.write(rows)
+        more = more and cursor
+    writer.flush()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', required=True, help='host of the app, e.g. my-app.appspot.com')
+    parser.add_argument('--output', default='export')
+    parser.add_argument('--format', choices=('npz', 'csv'), default='npz')
+    args = parser.parse_args(argv)
+
+    from google.appengine.ext.remote_api import remote_api_stub
+    remote_api_stub.ConfigureRemoteApiForOAuth(args.server, '/_ah/remote_api')
+    from models import Score, ScoreArchive, Game
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    scores = ChunkWriter(args.output, 'scores', SCORE_COLUMNS, args.format)
+    export(Score.query(), lambda score: [score_row(score)], scores)
+    export(ScoreArchive.query(), lambda archive: [archived_score_row(entry) for entry in archive.rows], scores)
+    games = ChunkWriter(args.output, 'games', GAME_COLUMNS, args.format)
+    export(Game.query(), lambda game: [game_row(game)], games)
+    print 'Exported {} scores in {} chunks and {} games in {} chunks to {}'.format(
+        scores.rows, scores.chunks, games.rows, games.chunks, args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,137 @@
+"""instrumentation.py - Per-endpoint datastore RPC and latency instrumentation.
+
+Endpoint methods and task/cron handlers are wrapped with `instrumented`. On a
+sampled request the wrapper counts the datastore gets, queries, puts and
+deletes issued while it runs, and times the whole request. Response encoding
+is not timed: endpoints encodes the returned message after the wrapper has
+returned, and encoding it a second time here to time it would add that cost to
+every sampled request. Totals and a latency histogram are folded into memcache
+counters with a single offset_multi call. Unsampled requests only pay for one
+random number."""
+
+import collections
+import functools
+import os
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+# Fraction of requests that are measured, set in app.yaml.
+SAMPLE_RATE = float(os.environ.get('INSTRUMENTATION_SAMPLE_RATE', '0.01'))
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+MEMCACHE_INSTRUMENTATION = 'INSTRUMENTATION:{}:{}'
+DATASTORE_OPS = {'Get': 'gets', 'RunQuery': 'queries', 'Next': 'queries',
+                 'Put': 'puts', 'Delete': 'deletes'}
+COUNTERS = ('calls', 'wall_ms', 'gets', 'queries', 'puts', 'deletes')
+
+_instrumented_names = []
+_state = threading.local()
+
+
+class RpcCounter(object):
+    """Counts datastore RPCs by method, and entities written, as an apiproxy
+    pre-call hook. Sampled requests get one each through this module's hook;
+    benchmark.py registers its own for a whole run."""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.writes = 0
+
+    def __call__(self, service, call, request, response):
+        self.calls[call] += 1
+        if call == 'Put':
+            self.writes += request.entity_size()
+        elif call == 'Delete':
+            self.writes += request.key_size()
+
+    def snapshot(self):
+        return dict(self.calls), self.writes
+
+
+def _count_rpc(service, call, request, response):
+    counter = getattr(_state, 'counter', None)
+    if counter is not None:
+        counter(service, call, request, response)
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    'instrumentation', _count_rpc, 'datastore_v3')
+
+
+def _bucket(elapsed_ms):
+    for edge in LATENCY_BUCKETS_MS:
+        if elapsed_ms <= edge:
+            return str(edge)
+    return 'inf'
+
+
+def instrumented(name):
+    """Decorator that samples the datastore usage and latency of a request
+    handler or endpoint method under the given name"""
+    _instrumented_names.append(name)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Nested instrumented calls are measured by the outermost one.
+            if getattr(_state, 'counter', None) is not None or random.random() >= SAMPLE_RATE:
+                return func(*args, **kwargs)
+            _state.counter = RpcCounter()
+            counts = collections.Counter()
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                for call, count in _state.counter.calls.items():
+                    if call in DATASTORE_OPS:
+                        counts[DATASTORE_OPS[call]] += count
+                _state.counter = None
+                elapsed_ms = int((time.time() - start) * 1000)
+                counts['calls'] = 1
+                counts['wall_ms'] = elapsed_ms
+                counts['bucket_' + _bucket(elapsed_ms)] = 1
+                memcache.offset_multi(
+                    dict((MEMCACHE_INSTRUMENTATION.format(name, counter), value)
+                         for counter, value in counts.items()),
+                    initial_value=0)
+        return wrapper
+    return decorator
+
+
+def get_stats():
+    """Returns the sampled totals of every instrumented name, with means per
+    request, the latency histogram and an estimate of the total call count"""
+    counters = list(COUNTERS) + ['bucket_' + str(edge) for edge in LATENCY_BUCKETS_MS] + ['bucket_inf']
+    values = memcache.get_multi([MEMCACHE_INSTRUMENTATION.format(name, counter)
+                                 for name in _instrumented_names for counter in counters])
+    stats = {}
+    for name in _instrumented_names:
+        totals = dict((counter, int(values.get(MEMCACHE_INSTRUMENTATION.format(name, counter), 0)))
+                      for counter in counters)
+        calls = totals['calls']
+        if not calls:
+            continue
+        stats[name] = {
+            'sampled_calls': calls,
+            'estimated_calls': int(calls / SAMPLE_RATE) if SAMPLE_RATE else calls,
+            'histogram_ms': dict((counter[len('bucket_'):], totals[counter])
+                                 for counter in counters
+                                 if counter.startswith('bucket_') and totals[counter]),
+        }
+        for counter in COUNTERS[1:]:
+            stats[name]['mean_' + counter] = float(totals[counter]) / calls
+        for percent in (50, 99):
+            stats[name]['p{}_ms_upper_bound'.format(percent)] = _percentile_bucket(totals, calls, percent)
+    return stats
+
+
+def _percentile_bucket(totals, calls, percent):
+    """Returns the upper edge of the histogram bucket holding a percentile"""
+    seen = 0
+    for edge in [str(edge) for edge in LATENCY_BUCKETS_MS] + ['inf']:
+        seen += totals['bucket_' + edge]
+        if seen * 100 >= calls * percent:
+            return edge
+    return 'inf'
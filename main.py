@@ -2,22 +2,150 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import collections
+import datetime
+import json
 import logging
+import os
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import GetYourBonusDayApi
+from instrumentation import instrumented, get_stats, SAMPLE_RATE
+import coalesce
+from utils import user_cache_stats
 
-from models import User
+from models import User, Game, Score, UserStats, Leaderboard, ReminderRun, ReminderPage, Backfill, \
+    get_user_names, ScoreArchive, UserScoreArchive, ScoreCompaction
+
+REMINDER_PAGE_SIZE = 100
+REMINDER_PAGES_PER_FANOUT = 10
+REMINDER_RESUME_AFTER = datetime.timedelta(minutes=10)
+BACKFILL_BATCH_SIZE = 200
+USER_STATS_BACKFILL_BATCH_SIZE = 50
+BACKFILL_RESUME_AFTER = datetime.timedelta(minutes=10)
+# Kinds given a user_name by the user_names Backfill, in order.
+USER_NAME_BACKFILL_KINDS = (('Game', Game), ('Score', Score))
+# Days a Score is kept before it is compacted into a ScoreArchive, set in app.yaml.
+SCORE_RETENTION_DAYS = int(os.environ.get('SCORE_RETENTION_DAYS', '90'))
+SCORE_COMPACTION_BATCH_SIZE = 500
+SCORE_COMPACTION_RESUME_AFTER = datetime.timedelta(minutes=10)
+# Hours without a move after which an unfinished Game expires, set in app.yaml.
+GAME_EXPIRE_AFTER = datetime.timedelta(hours=int(os.environ.get('GAME_EXPIRE_AFTER_HOURS', '168')))
+GAME_REAPER_BATCH_SIZE = 100
+REAPER_TIME_FORMAT = '%Y%m%d%H%M%S'
 
 
 class SendReminderEmail(webapp2.RequestHandler):
+    @instrumented('cron.send_reminder')
     def get(self):
         """Send a reminder email to the users who haven't completed the games they started.
-        Called every hour using a cron job"""
+        Called every hour using a cron job. Starts a new ReminderRun, or resumes
+        the latest one from its checkpoint if its fan-out has stalled."""
+        run = ReminderRun.query().order(-ReminderRun.started).get()
+        if run and not run.finished:
+            if datetime.datetime.utcnow() - run.updated < REMINDER_RESUME_AFTER:
+                return
+            run.resumes += 1
+            run.put()
+            logging.warning('Resuming reminder run %s from page %s', run.key.id(), run.pages)
+        else:
+            run = ReminderRun()
+            run.put()
+        _enqueue_reminder_fanout(run)
+
+
+def _enqueue_reminder_fanout(run):
+    """Enqueues the next fan-out step of a run. The task is named after the
+    run's checkpoint, so a step is never enqueued twice."""
+    try:
+        taskqueue.add(url='/tasks/reminder_fanout',
+                      params={'run_id': run.key.id()},
+                      name='reminder-fanout-{}-{}-{}'.format(run.key.id(), run.pages, run.resumes))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class ReminderFanout(webapp2.RequestHandler):
+    @instrumented('task.reminder_fanout')
+    def post(self):
+        """Page through the users to remind with a keys-only query and enqueue
+        one SendReminders task per page, checkpointing the cursor after each
+        step. Re-enqueues itself until every page has been handed out."""
+        run = ReminderRun.get_by_id(int(self.request.get('run_id')))
+        if not run or run.finished:
+            return
+        query = User.query(User.game_over == False, User.email > None).order(User.email)
+        cursor = Cursor(urlsafe=run.cursor) if run.cursor else None
+        tasks = []
+        more = True
+        while more and len(tasks) < REMINDER_PAGES_PER_FANOUT:
+            keys, cursor, more = query.fetch_page(REMINDER_PAGE_SIZE, start_cursor=cursor,
+                                                  keys_only=True)
+            if keys:
+                page = run.pages + len(tasks)
+                tasks.append(taskqueue.Task(
+                    url='/tasks/send_reminders',
+                    params={'run_id': run.key.id(), 'page': page,
+                            'user_keys': ','.join(key.urlsafe() for key in keys)},
+                    name='reminder-send-{}-{}'.format(run.key.id(), page)))
+                run.users += len(keys)
+        if tasks:
+            try:
+                taskqueue.Queue().add(tasks)
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                # A retried step: the pages it hands out were already enqueued.
+                pass
+        run.pages += len(tasks)
+        run.cursor = cursor.urlsafe() if more and cursor else None
+        if not more:
+            run.finished = datetime.datetime.utcnow()
+        run.put()
+
+        if more:
+            _enqueue_reminder_fanout(run)
+        else:
+            duration = (run.finished - run.started).total_seconds()
+            logging.info('Reminder run %s fanned out %s users in %s pages in %.1fs (%.1f users/s)',
+                         run.key.id(), run.users, run.pages, duration,
+                         run.users / duration if duration else 0)
+            _report_reminder_run(run)
+
+
+class SendReminders(webapp2.RequestHandler):
+    @instrumented('task.send_reminders')
+    def post(self):
+        """Send reminder emails to one page of users, at most once"""
+        run_id = int(self.request.get('run_id'))
+        page_key = ReminderPage.key_for(run_id, int(self.request.get('page')))
+        page = ReminderPage.claim(page_key)
+        if not page:
+            page = page_key.get()
+            if page.finished:
+                return
+            # An earlier attempt stopped while sending, after some of the
+            # emails may have gone out; close the page rather than resend it.
+            logging.warning('Reminder page %s was interrupted; not sending it again', page_key.id())
+        else:
+            page.sent = self._send(ndb.Key(urlsafe=key) for key in self.request.get('user_keys').split(','))
+        page.finished = datetime.datetime.utcnow()
+        page.put()
+
+        run = ReminderRun.get_by_id(run_id)
+        if run and run.finished:
+            _report_reminder_run(run)
+
+    @staticmethod
+    def _send(keys):
+        """Emails the Users who still have a game to finish. Returns the
+        number of emails sent."""
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None and User.game_over == False)
-        for user in users:
+        sent = 0
+        for user in ndb.get_multi(list(keys)):
+            if not user or not user.email or user.game_over:
+                continue
             subject = 'This is a reminder!'
             body = 'Hello {}, you have not completed your game. Come back to play more!'.format(user.name)
             # This will send test emails, the arguments to send_mail are:
@@ -26,16 +154,390 @@ class SendReminderEmail(webapp2.RequestHandler):
                            user.email,
                            subject,
                            body)
+            sent += 1
+        return sent
+
+
+def _report_reminder_run(run):
+    """Logs and stores the totals of a run once every page has been sent"""
+    if run.completed:
+        return
+    run_id = run.key.id()
+    pages = ndb.get_multi([ReminderPage.key_for(run_id, page) for page in range(run.pages)])
+    if not all(page and page.finished for page in pages):
+        return
+    run.sent = sum(page.sent for page in pages)
+    run.completed = datetime.datetime.utcnow()
+    run.put()
+    duration = (run.completed - run.started).total_seconds()
+    logging.info('Reminder run %s sent %s emails to %s users in %.1fs (%.1f emails/s)',
+                 run_id, run.sent, run.users, duration,
+                 run.sent / duration if duration else 0)
+
 
+class ReconcileAverageAttempts(webapp2.RequestHandler):
+    @instrumented('cron.reconcile_average_attempts')
+    def get(self):
+        """Recompute the running aggregate of attempts remaining to correct
+        drift. Called every day using a cron job"""
+        GetYourBonusDayApi._reconcile_average_attempts()
+        self.response.set_status(204)
+
+
+class ReapGames(webapp2.RequestHandler):
+    @instrumented('cron.reap_games')
+    def get(self):
+        """Expire the unfinished games idle for longer than GAME_EXPIRE_AFTER.
+        Called every day using a cron job"""
+        idle_since = datetime.datetime.utcnow() - GAME_EXPIRE_AFTER
+        _enqueue_reaper_step(idle_since.strftime(REAPER_TIME_FORMAT), None, 0)
 
-class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+
+def _enqueue_reaper_step(idle_since, cursor, step):
+    """Enqueues a step of the reaper run for idle_since, named after the
+    run and step so a step is never enqueued twice"""
+    params = {'idle_since': idle_since, 'step': step}
+    if cursor:
+        params['cursor'] = cursor.urlsafe()
+    try:
+        taskqueue.add(url='/tasks/reap_games', params=params,
+                      name='reap-games-{}-{}'.format(idle_since, step))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class ReapGamesStep(webapp2.RequestHandler):
+    @instrumented('task.reap_games')
+    def post(self):
+        """Expire one batch of the idle unfinished games, then enqueue the
+        next batch until none is left"""
+        idle_since = self.request.get('idle_since')
+        step = int(self.request.get('step'))
+        cursor = Cursor(urlsafe=self.request.get('cursor')) if self.request.get('cursor') else None
+        cutoff = datetime.datetime.strptime(idle_since, REAPER_TIME_FORMAT)
+        query = Game.query(Game.game_over == False, Game.last_activity < cutoff)
+        keys, cursor, more = query.fetch_page(GAME_REAPER_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        # Each Game ends in its own transaction, one at a time: a transaction
+        # may enqueue a transactional leaderboard task, which attaches to the
+        # thread's current transaction, and Games of one User would contend
+        # for its entity group. The aggregate change is applied once.
+        expired, total, count = 0, 0, 0
+        for key in keys:
+            change = GetYourBonusDayApi._expire_game_async(key, cutoff).get_result()
+            if change:
+                expired += 1
+                total += change[0]
+                count += change[1]
+        GetYourBonusDayApi._adjust_aggregate_async(total, count).get_result()
+        logging.info('Reaper step %s for games idle since %s expired %s of %s games',
+                     step, cutoff, expired, len(keys))
+        if more and cursor:
+            _enqueue_reaper_step(idle_since, cursor, step + 1)
+
+
+class UpdateLeaderboard(webapp2.RequestHandler):
+    @instrumented('task.update_leaderboard')
+    def post(self):
+        """Offer a newly stored Score to the leaderboard.
+        Enqueued by Game.end_game when the Score may place"""
+        score = ndb.Key(urlsafe=self.request.get('score_key')).get()
+        if score:
+            Leaderboard.offer(score)
+        self.response.set_status(204)
+
+
+class RebuildLeaderboard(webapp2.RequestHandler):
+    @instrumented('task.rebuild_leaderboard')
     def post(self):
-        """Update game listing announcement in memcache."""
-        GetYourBonusDayApi._cache_average_attempts()
+        """Recompute the leaderboard from the Score queries"""
+        Leaderboard.rebuild()
         self.response.set_status(204)
 
 
+class CompactScores(webapp2.RequestHandler):
+    @instrumented('cron.compact_scores')
+    def get(self):
+        """Start folding the Scores older than SCORE_RETENTION_DAYS into
+        ScoreArchives. Called every day using a cron job"""
+        # The fallback read paths of both backfills read Scores.
+        if not (Backfill.is_complete(Backfill.USER_NAMES) and Backfill.is_complete(Backfill.USER_STATS)):
+            logging.warning('Score compaction waits for the user_names and user_stats backfills')
+            return
+        compaction = ScoreCompaction.get_or_insert(ScoreCompaction.ID)
+        if compaction.run and not compaction.finished and \
+                datetime.datetime.utcnow() - compaction.updated < SCORE_COMPACTION_RESUME_AFTER:
+            return
+        compaction.run = datetime.datetime.utcnow().strftime('%Y%m%d%H%M')
+        compaction.finished = None
+        compaction.put()
+        _enqueue_compaction_step(compaction)
+
+
+def _enqueue_compaction_step(compaction):
+    """Enqueues the next compaction step, named after the run and its
+    checkpoint so a step is never enqueued twice"""
+    try:
+        taskqueue.add(url='/tasks/compact_scores',
+                      params={'run': compaction.run, 'step': compaction.steps},
+                      name='compact-scores-{}-{}'.format(compaction.run, compaction.steps))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+@ndb.transactional(xg=True)
+def _store_archive(archive, compaction):
+    ndb.put_multi([archive, compaction])
+
+
+class CompactScoresStep(webapp2.RequestHandler):
+    @instrumented('task.compact_scores')
+    def post(self):
+        """Fold one batch of the expired Scores of the oldest day into a
+        ScoreArchive, the per-user archives and the archive board, then
+        delete them. Re-enqueues itself until no Score has expired."""
+        compaction = ScoreCompaction.get_by_id(ScoreCompaction.ID)
+        if not compaction or compaction.run != self.request.get('run') or compaction.finished:
+            return
+        if int(self.request.get('step')) < compaction.steps:
+            # A retried step that already checkpointed.
+            _enqueue_compaction_step(compaction)
+            return
+
+        if not compaction.pending:
+            cutoff = datetime.date.today() - datetime.timedelta(days=SCORE_RETENTION_DAYS)
+            oldest = Score.query(Score.date < cutoff).order(Score.date).get()
+            if not oldest:
+                compaction.finished = datetime.datetime.utcnow()
+                compaction.put()
+                logging.info('Score compaction archived %s Scores in total', compaction.archived)
+                return
+            # Keys first, then gets, so Scores deleted by an earlier batch
+            # never reappear from a stale index.
+            keys = Score.query(Score.date == oldest.date).fetch(SCORE_COMPACTION_BATCH_SIZE, keys_only=True)
+            scores = sorted([score for score in ndb.get_multi(keys) if score and score.date == oldest.date],
+                            key=lambda score: score.key)
+            if scores:
+                archive = ScoreArchive.from_scores(oldest.date, scores)
+                compaction.pending = archive.key.id()
+                _store_archive(archive, compaction)
+
+        if compaction.pending:
+            archive = ScoreArchive.get_by_id(compaction.pending)
+            _apply_archive(archive)
+            compaction.archived += len(archive.rows)
+            compaction.pending = None
+        compaction.steps += 1
+        compaction.put()
+        _enqueue_compaction_step(compaction)
+
+
+def _apply_archive(archive):
+    """Folds the rows of a stored ScoreArchive into the per-user archives
+    and the archive board and deletes its Scores. Every part ignores rows it
+    already holds, so a retry repeats it safely."""
+    rows_by_user = collections.defaultdict(list)
+    for row in archive.rows:
+        rows_by_user[ndb.Key(urlsafe=row['user_key'])].append(row)
+    summary_keys = [UserScoreArchive.key_for(user_key, archive.date) for user_key in rows_by_user]
+    summaries = ndb.get_multi(summary_keys)
+    for index, user_key in enumerate(rows_by_user):
+        summaries[index] = summaries[index] or UserScoreArchive(key=summary_keys[index])
+        summaries[index].add(rows_by_user[user_key])
+    ndb.put_multi(summaries)
+    Leaderboard.archive(archive.rows)
+    ndb.delete_multi([ndb.Key(Score, row['id']) for row in archive.rows])
+
+
+class StartBackfill(webapp2.RequestHandler):
+    @instrumented('admin.backfill')
+    def get(self, name):
+        """Start the named Backfill, or resume it from its checkpoint if its
+        task chain has stalled"""
+        backfill = Backfill.get_by_id(name)
+        if backfill and backfill.completed:
+            self.response.write('The backfill completed on {}.'.format(backfill.completed))
+            return
+        if backfill:
+            if datetime.datetime.utcnow() - backfill.updated < BACKFILL_RESUME_AFTER:
+                self.response.write('The backfill is running: {} steps.'.format(backfill.steps))
+                return
+            backfill.resumes += 1
+            logging.warning('Resuming backfill %s at step %s', name, backfill.steps)
+        else:
+            backfill = Backfill(id=name)
+        backfill.put()
+        _enqueue_backfill_step(backfill)
+        self.response.write('The backfill is enqueued.')
+
+
+def _enqueue_backfill_step(backfill):
+    """Enqueues the next step of a Backfill, named after its checkpoint so a
+    step is never enqueued twice"""
+    name = backfill.key.id()
+    try:
+        taskqueue.add(url='/tasks/backfill_{}'.format(name),
+                      params={'step': backfill.steps},
+                      name='backfill-{}-{}-{}'.format(name, backfill.steps, backfill.resumes))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+class BackfillStep(webapp2.RequestHandler):
+    """Runs one batch of the NAME Backfill per task, checkpoints its cursor
+    and enqueues the next batch until run_batch reports no more work.
+    Subclasses implement run_batch(backfill, cursor), returning the cursor,
+    whether more remains and how many entities were updated."""
+    NAME = None
+
+    def step(self):
+        backfill = Backfill.get_by_id(self.NAME)
+        if not backfill or backfill.completed:
+            return
+        if int(self.request.get('step')) < backfill.steps:
+            # A retried step that already checkpointed; only the next
+            # step's enqueue may be missing.
+            _enqueue_backfill_step(backfill)
+            return
+
+        cursor = Cursor(urlsafe=backfill.cursor) if backfill.cursor else None
+        cursor, more, updated = self.run_batch(backfill, cursor)
+        backfill.steps += 1
+        backfill.entities += updated
+        backfill.cursor = cursor.urlsafe() if more and cursor else None
+        if not more:
+            backfill.completed = datetime.datetime.utcnow()
+        backfill.put()
+
+        if backfill.completed:
+            logging.info('Backfill %s updated %s entities in %s steps',
+                         self.NAME, backfill.entities, backfill.steps)
+        else:
+            _enqueue_backfill_step(backfill)
+
+
+@ndb.transactional_tasklet
+def _set_user_name_async(key, user_name):
+    """Sets user_name on a Game or Score unless a move got there first"""
+    entity = yield key.get_async()
+    if entity and entity.user_name is None:
+        entity.user_name = user_name
+        yield entity.put_async()
+
+
+class BackfillUserNames(BackfillStep):
+    NAME = Backfill.USER_NAMES
+
+    @instrumented('task.backfill_user_names')
+    def post(self):
+        """Copy the owner's name onto one batch of the Games, then the
+        Scores, stored before it was denormalized"""
+        self.step()
+
+    def run_batch(self, backfill, cursor):
+        kinds = [kind for kind, _ in USER_NAME_BACKFILL_KINDS]
+        backfill.kind = backfill.kind or kinds[0]
+        model = dict(USER_NAME_BACKFILL_KINDS)[backfill.kind]
+        entities, cursor, more = model.query().fetch_page(BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        missing = [entity for entity in entities if entity.user_name is None]
+        names = get_user_names([entity.user for entity in missing])
+        # Games may be played meanwhile, so each entity is updated in its own
+        # transaction, all of them concurrently.
+        futures = [_set_user_name_async(entity.key, names[entity.user]) for entity in missing]
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+
+        if not (more and cursor):
+            position = kinds.index(backfill.kind) + 1
+            if position < len(kinds):
+                # Start over on the next kind.
+                backfill.kind = kinds[position]
+                cursor, more = None, True
+        return cursor, more, len(missing)
+
+
+@ndb.tasklet
+def _seed_user_stats_async(user_key):
+    scores = yield Score.query(Score.user == user_key). \
+        fetch_async(projection=[Score.won, Score.guesses])
+    seeded = yield UserStats.seed_async(user_key, scores)
+    raise ndb.Return(seeded)
+
+
+class BackfillUserStats(BackfillStep):
+    NAME = Backfill.USER_STATS
+
+    @instrumented('task.backfill_user_stats')
+    def post(self):
+        """Seed the UserStats of one batch of Users with the Scores they
+        finished before the rollup existed"""
+        self.step()
+
+    def run_batch(self, backfill, cursor):
+        keys, cursor, more = User.query().fetch_page(USER_STATS_BACKFILL_BATCH_SIZE,
+                                                     start_cursor=cursor, keys_only=True)
+        futures = [_seed_user_stats_async(key) for key in keys]
+        ndb.Future.wait_all(futures)
+        return cursor, more, sum(1 for future in futures if future.get_result())
+
+
+@ndb.transactional_tasklet
+def _stamp_last_activity_async(key, stamp):
+    """Sets last_activity on an unfinished Game unless a move got there first"""
+    game = yield key.get_async()
+    if game and not game.game_over and game.last_activity is None:
+        game.last_activity = stamp
+        yield game.put_async()
+
+
+class BackfillLastActivity(BackfillStep):
+    NAME = Backfill.LAST_ACTIVITY
+
+    @instrumented('task.backfill_last_activity')
+    def post(self):
+        """Stamp one batch of the unfinished Games stored before last_activity
+        existed with the time the backfill started, from which the reaper
+        counts their idle time"""
+        self.step()
+
+    def run_batch(self, backfill, cursor):
+        games, cursor, more = Game.query(Game.game_over == False). \
+            fetch_page(BACKFILL_BATCH_SIZE, start_cursor=cursor)
+        missing = [game for game in games if game.last_activity is None]
+        futures = [_stamp_last_activity_async(game.key, backfill.started) for game in missing]
+        ndb.Future.wait_all(futures)
+        for future in futures:
+            future.check_success()
+        return cursor, more, len(missing)
+
+
+class InstrumentationStats(webapp2.RequestHandler):
+    def get(self):
+        """Return the sampled per-endpoint datastore and latency figures, the
+        coalesced task counters and this instance's user lookup cache
+        counters, as JSON"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'sample_rate': SAMPLE_RATE,
+                                        'endpoints': get_stats(),
+                                        'coalesced_tasks': coalesce.get_stats(),
+                                        'user_cache': user_cache_stats()},
+                                       indent=2, sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
-    ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/crons/reconcile_average_attempts', ReconcileAverageAttempts),
+    ('/crons/compact_scores', CompactScores),
+    ('/crons/reap_games', ReapGames),
+    ('/tasks/reminder_fanout', ReminderFanout),
+    ('/tasks/send_reminders', SendReminders),
+    ('/tasks/update_leaderboard', UpdateLeaderboard),
+    ('/tasks/rebuild_leaderboard', RebuildLeaderboard),
+    ('/tasks/compact_scores', CompactScoresStep),
+    ('/tasks/reap_games', ReapGamesStep),
+    ('/tasks/backfill_user_names', BackfillUserNames),
+    ('/tasks/backfill_user_stats', BackfillUserStats),
+    ('/tasks/backfill_last_activity', BackfillLastActivity),
+    ('/admin/backfill_(user_names|user_stats|last_activity)', StartBackfill),
+    ('/admin/instrumentation', InstrumentationStats),
 ], debug=True)
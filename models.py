@@ -3,21 +3,76 @@ entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
 import random
-from datetime import date
+from array import array
+from datetime import date, datetime
 from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
+from cache import CachedModel
+
+LEADERBOARD_SIZE = 100
+LEADERBOARD_CACHE_TTL = 60
+MEMCACHE_LEADERBOARD = 'LEADERBOARD'
+
+# Code table for Game history messages. Codes are stored, so only append.
+HISTORY_MESSAGES = (
+    'Game already over!',
+    'Invalid guess! No such date!',
+    'Congratulations! You picked the correct date.',
+    'You guessed higher.',
+    'You guessed lower.',
+    'Incorrect. Game over!',
+    'Game expired after inactivity.',
+)
+
+
+def get_user_names(user_keys, names=None):
+    """Resolves User keys to user names; see get_user_names_async"""
+    return get_user_names_async(user_keys, names).get_result()
+
+
+@ndb.tasklet
+def get_user_names_async(user_keys, names=None):
+    """Resolves User keys to user names with a single batched get.
+    Args:
+        user_keys: An iterable of User keys, duplicates allowed
+        names: An optional request-scoped dict of key -> name. Keys already
+            present are not fetched again.
+    Returns:
+        The names dict, updated with every key in user_keys."""
+    if names is None:
+        names = {}
+    missing = list(set(key for key in user_keys if key not in names))
+    if missing:
+        users = yield ndb.get_multi_async(missing)
+        for key, user in zip(missing, users):
+            names[key] = user.name if user else ''
+    raise ndb.Return(names)
+
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile, keyed by name"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
     num_of_wons = ndb.IntegerProperty(required=True, default=0)
     game_over = ndb.BooleanProperty(required=True, default=False)
     attempts_allowed = ndb.IntegerProperty()
 
+    @classmethod
+    @ndb.transactional
+    def insert(cls, name, email=None):
+        """Creates and returns a User keyed by name, together with an empty
+        UserStats, or None if a User with that name already exists"""
+        if cls.get_by_id(name):
+            return None
+        user = cls(id=name, name=name, email=email)
+        ndb.put_multi([user, UserStats(key=UserStats.key_for(user.key), seeded=True)])
+        return user
 
-class Game(ndb.Model):
+
+class Game(CachedModel):
     """Game object"""
     target = ndb.IntegerProperty(required=True)
     attempts_allowed = ndb.IntegerProperty(required=True)
@@ -27,27 +82,58 @@ class Game(ndb.Model):
     num_of_wons = ndb.IntegerProperty(required=True, default=0)
     won = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
-    history = ndb.PickleProperty(required=True, default=[])
+    # Copy of the User's name, so forms need no User get. Games stored before
+    # it was added lack it until the user_names Backfill reaches them.
+    user_name = ndb.StringProperty(indexed=False)
+    # Time of the creation or last move, used to expire abandoned games. Set
+    # explicitly, as maintenance writes are not activity. Unfinished games
+    # stored before it was added get it from the last_activity Backfill.
+    last_activity = ndb.DateTimeProperty()
+    # History is kept as parallel arrays: one HISTORY_MESSAGES code byte and
+    # one packed int nth_guess per entry. They stay raw strings until
+    # get_history decodes them.
+    history_codes = ndb.BlobProperty(default='')
+    history_guesses = ndb.BlobProperty(default='')
+    # Pickled list of dicts written by games stored before the compact form.
+    legacy_history = ndb.PickleProperty('history')
 
     @classmethod
-    def new_game(cls, user, attempts):
+    def new_game(cls, user, attempts, user_name=None):
         """Creates and returns a new game"""
+        return cls.new_game_async(user, attempts, user_name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def new_game_async(cls, user, attempts, user_name=None):
         game = Game(user=user,
+                    user_name=user_name,
                     num_of_wons=0,
                     target=random.choice(range(1, 32)),
                     attempts_allowed=attempts,
                     attempts_remaining=attempts,
                     game_over=False,
-                    won=False)
-        game.history = []
-        game.put()
-        return game
+                    won=False,
+                    last_activity=datetime.utcnow())
+        yield game.put_async()
+        raise ndb.Return(game)
 
-    def to_form(self, message):
+    def to_form(self, message, user_name=None):
         """Returns a GameForm representation of the Game"""
+        return self.to_form_async(message, user_name).get_result()
+
+    @ndb.tasklet
+    def to_form_async(self, message, user_name=None):
+        if user_name is None:
+            user_name = self.user_name
+        if user_name is None:
+            user = yield self.user.get_async()
+            user_name = user.name
+        raise ndb.Return(self._form(message, user_name))
+
+    def _form(self, message, user_name):
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user_name
         form.attempts_remaining = self.attempts_remaining
         form.num_of_wons = self.num_of_wons
         form.game_over = self.game_over
@@ -55,41 +141,504 @@ class Game(ndb.Model):
         form.message = message
         return form
 
-    def end_game(self, won, num_of_wons):
+    @classmethod
+    def to_forms(cls, games, message, names=None):
+        """Returns a GameForms representation of the Games"""
+        return cls.to_forms_async(games, message, names).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def to_forms_async(cls, games, message, names=None):
+        """Returns a GameForms representation of the Games, resolving the
+        names missing from them with one batched get"""
+        games = list(games)
+        names = yield get_user_names_async([game.user for game in games if game.user_name is None], names)
+        raise ndb.Return(GameForms(items=[game._form(message, game.user_name
+                                                     if game.user_name is not None else names[game.user])
+                                          for game in games]))
+
+    def end_game(self, won, num_of_wons, stats=None):
+        """Ends the game; see end_game_async"""
+        return self.end_game_async(won, num_of_wons, stats).get_result()
+
+    @ndb.tasklet
+    def end_game_async(self, won, num_of_wons, stats=None):
         """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+        the player lost. Returns the Score for the 'board'; the caller stores
+        it together with the Game. The Score is keyed by the Game's id so
+        that a retried commit cannot record the same game twice. If the
+        player's UserStats is given, the Score is folded into it and the
+        caller stores it in the same commit. Must run in the transaction
+        that stores the Score, which the leaderboard task joins."""
         self.game_over = True
-        self.put()
-        # Add the game to the score 'board'
-        score = Score(user=self.user, date=date.today(), won=won,
+        score = Score(id=str(self.key.id()), user=self.user, user_name=self.user_name,
+                      date=date.today(), won=won, attempts_allowed=self.attempts_allowed,
                       guesses=self.attempts_allowed - self.attempts_remaining, num_of_wons=num_of_wons)
-        score.put()
+        if stats is not None:
+            stats.record(score)
+        # Offer the Score to the materialized leaderboard once it is stored.
+        qualifies = yield Leaderboard.qualifies_async(num_of_wons, won)
+        if qualifies:
+            taskqueue.add(url='/tasks/update_leaderboard',
+                          params={'score_key': score.key.urlsafe()},
+                          transactional=True)
+        raise ndb.Return(score)
 
     def canceled_game(self):
         self.game_canceled = True
-        self.put()
+
+    def attempts_contribution(self):
+        """Returns this Game's (attempts remaining, game count) share of the
+        running aggregate. Finished games do not contribute."""
+        if self.game_over:
+            return 0, 0
+        return self.attempts_remaining, 1
 
     def add_game_history(self, result, guesses):
         if isinstance(result, str) and isinstance(guesses, int):
-            self.history.append({'message': result, 'nth_guess': guesses})
-            self.history = self.history
-            self.put()
+            self.history_codes += chr(HISTORY_MESSAGES.index(result))
+            self.history_guesses += array('i', [guesses]).tostring()
         else:
             raise
 
+    def get_history(self):
+        """Decodes the history into a list of {'message', 'nth_guess'} dicts"""
+        guesses = array('i')
+        guesses.fromstring(self.history_guesses or '')
+        return list(self.legacy_history or []) + \
+            [{'message': HISTORY_MESSAGES[code], 'nth_guess': nth_guess}
+             for code, nth_guess in zip(array('B', self.history_codes or ''), guesses)]
+
 
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
+    # Copy of the User's name, indexed for the Leaderboard projection queries.
+    user_name = ndb.StringProperty()
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True, default=False)
     guesses = ndb.IntegerProperty(required=True)
     num_of_wons = ndb.IntegerProperty(required=True, default=0)
+    # Missing on Scores stored before it was added.
+    attempts_allowed = ndb.IntegerProperty(indexed=False)
+
+    def to_form(self, user_name=None):
+        return self.to_form_async(user_name).get_result()
 
-    def to_form(self):
-        return ScoreForm(user_name=self.user.get().name, won=self.won,
+    @ndb.tasklet
+    def to_form_async(self, user_name=None):
+        if user_name is None:
+            user_name = self.user_name
+        if user_name is None:
+            user = yield self.user.get_async()
+            user_name = user.name
+        raise ndb.Return(self._form(user_name))
+
+    def _form(self, user_name):
+        return ScoreForm(user_name=user_name, won=self.won,
                          date=str(self.date), guesses=self.guesses, num_of_wons=self.num_of_wons)
 
+    @classmethod
+    def to_forms(cls, scores, names=None):
+        """Returns a ScoreForms representation of the Scores"""
+        return cls.to_forms_async(scores, names).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def to_forms_async(cls, scores, names=None):
+        """Returns a ScoreForms representation of the Scores, resolving the
+        names missing from them with one batched get"""
+        scores = list(scores)
+        names = yield get_user_names_async([score.user for score in scores if score.user_name is None], names)
+        raise ndb.Return(ScoreForms(items=[score._form(score.user_name
+                                                       if score.user_name is not None else names[score.user])
+                                           for score in scores]))
+
+
+class GameTotals(ndb.Model):
+    """Base of the rollups of finished games"""
+    games = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    wins = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    total_guesses = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    # Number of finished games by guess count, keyed by str(guesses).
+    guess_histogram = ndb.JsonProperty(indexed=False)
+
+    def _add(self, won, guesses):
+        self.games += 1
+        self.wins += 1 if won else 0
+        self.total_guesses += guesses
+        histogram = dict(self.guess_histogram or {})
+        histogram[str(guesses)] = histogram.get(str(guesses), 0) + 1
+        self.guess_histogram = histogram
+
+
+class UserStats(GameTotals):
+    """Rollup of the games a User has finished. A child of the User, so the
+    move that ends a game updates it in the same transaction. Rollups
+    created before the user_stats Backfill reached their User are not seeded
+    with the older Scores yet; until then they list the Scores they hold."""
+    seeded = ndb.BooleanProperty(required=True, default=False, indexed=False)
+    recorded = ndb.StringProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, user_key):
+        return ndb.Key(cls, 'stats', parent=user_key)
+
+    def record(self, score):
+        """Folds a new Score into the rollup"""
+        self._add(score.won, score.guesses)
+        if not self.seeded:
+            self.recorded.append(score.key.id())
+
+    def add_unrecorded(self, scores):
+        """Folds in every Score the rollup does not hold yet, which completes
+        it. Projections of won and guesses will do."""
+        recorded = set(self.recorded)
+        for score in scores:
+            if score.key.id() not in recorded:
+                self._add(score.won, score.guesses)
+        self.seeded = True
+        self.recorded = []
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def seed_async(cls, user_key, scores):
+        """Seeds the stored rollup of a User with their Scores unless it
+        already is. Returns True if it was seeded now."""
+        key = cls.key_for(user_key)
+        stats = yield key.get_async()
+        stats = stats or cls(key=key)
+        if stats.seeded:
+            raise ndb.Return(False)
+        stats.add_unrecorded(scores)
+        yield stats.put_async()
+        raise ndb.Return(True)
+
+    def to_form(self, user_name):
+        """Returns a UserStatsForm representation of the rollup"""
+        histogram = self.guess_histogram or {}
+        return UserStatsForm(user_name=user_name, games=self.games, wins=self.wins,
+                             win_rate=float(self.wins) / self.games if self.games else 0.0,
+                             total_guesses=self.total_guesses,
+                             average_guesses=float(self.total_guesses) / self.games if self.games else 0.0,
+                             guess_histogram=[GuessCountForm(guesses=int(guesses), games=histogram[guesses])
+                                              for guesses in sorted(histogram, key=int)])
+
+
+class Leaderboard(ndb.Model):
+    """The top LEADERBOARD_SIZE Scores, pre-sorted by num_of_wons with user
+    names denormalized, held in a single entity and mirrored in memcache.
+    high_scores ranks every Score; rankings ranks winning Scores only."""
+    high_scores = ndb.JsonProperty(required=True, default=[], indexed=False)
+    rankings = ndb.JsonProperty(required=True, default=[], indexed=False)
+
+    ID = 'global'
+    # Board of the Scores folded into ScoreArchives, merged in by build.
+    ARCHIVE_ID = 'archive'
+
+    @classmethod
+    def load(cls):
+        """Returns the stored Leaderboard, or None if it has not been built"""
+        cached = memcache.get(MEMCACHE_LEADERBOARD)
+        if cached is not None:
+            return cls(id=cls.ID, **cached)
+        board = cls.get_by_id(cls.ID)
+        if board:
+            board._cache()
+        return board
+
+    @classmethod
+    def build(cls):
+        """Returns an unsaved Leaderboard computed from the Score queries.
+        Once every Score carries its user name the queries are projections
+        and no User is read."""
+        archived = ndb.Key(cls, cls.ARCHIVE_ID).get_async()
+        high_scores = Score.query().order(-Score.num_of_wons)
+        rankings = Score.query().filter(Score.won == True).order(-Score.num_of_wons)
+        names = {}
+        if Backfill.is_complete(Backfill.USER_NAMES):
+            # won cannot be projected under the rankings filter; it is True.
+            fields = [Score.num_of_wons, Score.user_name, Score.date, Score.guesses]
+            high_scores = high_scores.fetch_async(LEADERBOARD_SIZE, projection=fields + [Score.won])
+            rankings = rankings.fetch(LEADERBOARD_SIZE, projection=fields)
+            high_scores = high_scores.get_result()
+        else:
+            high_scores = high_scores.fetch_async(LEADERBOARD_SIZE)
+            rankings = rankings.fetch(LEADERBOARD_SIZE)
+            high_scores = high_scores.get_result()
+            names = get_user_names([score.user for score in high_scores + rankings
+                                    if score.user_name is None])
+
+        def user_name(score):
+            return score.user_name if score.user_name is not None else names[score.user]
+        board = cls(id=cls.ID,
+                    high_scores=[cls.entry(score, user_name(score)) for score in high_scores],
+                    rankings=[cls.entry(score, user_name(score), won=True) for score in rankings])
+        archived = archived.get_result()
+        if archived:
+            for entry in archived.high_scores:
+                cls._insert(board.high_scores, entry)
+            for entry in archived.rankings:
+                cls._insert(board.rankings, entry)
+        return board
+
+    @classmethod
+    def rebuild(cls):
+        """Recomputes and stores the Leaderboard"""
+        board = cls.build()
+        board.put()
+        board._cache()
+
+    @classmethod
+    @ndb.tasklet
+    def qualifies_async(cls, num_of_wons, won):
+        """Returns False only if the cached Leaderboard shows the Score
+        cannot place"""
+        cached = yield ndb.get_context().memcache_get(MEMCACHE_LEADERBOARD)
+        if cached is None:
+            raise ndb.Return(True)
+        raise ndb.Return(cls._places(cached['high_scores'], num_of_wons) or
+                         (won and cls._places(cached['rankings'], num_of_wons)))
+
+    @classmethod
+    def offer(cls, score):
+        """Inserts a stored Score into the Leaderboard if it places"""
+        user_name = score.user_name
+        if user_name is None:
+            user_name = get_user_names([score.user])[score.user]
+        entry = cls.entry(score, user_name)
+        if cls._offer(entry):
+            memcache.delete(MEMCACHE_LEADERBOARD)
+
+    @classmethod
+    @ndb.transactional
+    def archive(cls, entries):
+        """Merges the entries of archived Scores into the archive board"""
+        board = cls.get_by_id(cls.ARCHIVE_ID) or cls(id=cls.ARCHIVE_ID, high_scores=[], rankings=[])
+        board._merge(entries)
+        board.put()
+
+    def _merge(self, entries):
+        for entry in entries:
+            self._insert(self.high_scores, entry)
+            if entry['won']:
+                self._insert(self.rankings, entry)
+
+    @classmethod
+    @ndb.transactional
+    def _offer(cls, entry):
+        board = cls.get_by_id(cls.ID)
+        if not board:
+            return False
+        changed = cls._insert(board.high_scores, entry)
+        if entry['won']:
+            changed = cls._insert(board.rankings, entry) or changed
+        if changed:
+            board.put()
+        return changed
+
+    @staticmethod
+    def entry(score, user_name, won=None):
+        return {'id': score.key.id(), 'user_name': user_name, 'date': str(score.date),
+                'won': score.won if won is None else won, 'guesses': score.guesses,
+                'num_of_wons': score.num_of_wons}
+
+    @staticmethod
+    def _places(entries, num_of_wons):
+        return len(entries) < LEADERBOARD_SIZE or num_of_wons > entries[-1]['num_of_wons']
+
+    @classmethod
+    def _insert(cls, entries, entry):
+        """Inserts entry after every entry with as many wins, keeping the list
+        at LEADERBOARD_SIZE. Returns True if the list changed."""
+        if any(existing['id'] == entry['id'] for existing in entries) or \
+                not cls._places(entries, entry['num_of_wons']):
+            return False
+        position = len(entries)
+        while position and entries[position - 1]['num_of_wons'] < entry['num_of_wons']:
+            position -= 1
+        entries.insert(position, entry)
+        del entries[LEADERBOARD_SIZE:]
+        return True
+
+    def _cache(self):
+        memcache.set(MEMCACHE_LEADERBOARD, {'high_scores': self.high_scores,
+                                            'rankings': self.rankings},
+                     time=LEADERBOARD_CACHE_TTL)
+
+    @staticmethod
+    def to_forms(entries):
+        """Returns a ScoreForms representation of Leaderboard entries"""
+        return ScoreForms(items=[ScoreForm(user_name=entry['user_name'], won=entry['won'],
+                                           date=entry['date'], guesses=entry['guesses'],
+                                           num_of_wons=entry['num_of_wons'])
+                                 for entry in entries])
+
+
+class AttemptsRemainingShard(ndb.Model):
+    """One shard of the running sum and count of attempts_remaining over all
+    unfinished Games. Updates pick a random shard so that concurrent writers
+    rarely contend for the same entity group. They are applied after the
+    Game write they follow has committed rather than inside its transaction,
+    so shard contention never fails a move; an update that is lost is drift
+    corrected by the reconcile cron."""
+    NUM_SHARDS = 20
+
+    total = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    @classmethod
+    def random_key(cls):
+        return ndb.Key(cls, random.randint(1, cls.NUM_SHARDS))
+
+    @classmethod
+    def all_keys(cls):
+        return [ndb.Key(cls, index) for index in range(1, cls.NUM_SHARDS + 1)]
+
+    @classmethod
+    def totals(cls):
+        """Returns the (total, count) summed over every shard"""
+        shards = [shard for shard in ndb.get_multi(cls.all_keys()) if shard]
+        return sum(shard.total for shard in shards), sum(shard.count for shard in shards)
+
+    @classmethod
+    def adjust(cls, total, count):
+        """Adds to the sum and count of a random shard. Joins the caller's
+        transaction if there is one."""
+        cls.adjust_async(total, count).get_result()
+
+    @classmethod
+    @ndb.transactional_async
+    def adjust_async(cls, total, count):
+        if not total and not count:
+            return
+        key = cls.random_key()
+        shard = key.get() or cls(key=key)
+        shard.add(total, count)
+        shard.put()
+
+    def add(self, total, count):
+        self.total += total
+        self.count += count
+
+
+class ScoreArchive(GameTotals):
+    """Scores of one day folded together by the compaction cron, in chunks
+    of at most one compaction batch. Holds the totals over its Scores and
+    the Scores themselves as Leaderboard entries, so that reading a past
+    day costs a get per chunk instead of one per game."""
+    date = ndb.DateProperty(required=True)
+    rows = ndb.JsonProperty(required=True, compressed=True)
+
+    @classmethod
+    def from_scores(cls, day, scores):
+        """Returns an unsaved chunk of a day's Scores, keyed by the day and
+        its first Score so a retried batch writes the same chunk. Each row
+        also holds its Score's User key, by which it is archived per user."""
+        archive = cls(id='{}:{}'.format(day.isoformat(), scores[0].key.id()), date=day,
+                      rows=[dict(Leaderboard.entry(score, score.user_name),
+                                 attempts_allowed=score.attempts_allowed, user_key=score.user.urlsafe())
+                            for score in scores])
+        for score in scores:
+            archive._add(score.won, score.guesses)
+        return archive
+
+
+class UserScoreArchive(ndb.Model):
+    """The archived Scores of one User on one day, as Leaderboard entries
+    by Score id. A child of the User, keyed by the day."""
+    rows = ndb.JsonProperty(required=True, compressed=True)
+
+    @classmethod
+    def key_for(cls, user_key, day):
+        return ndb.Key(cls, day.isoformat(), parent=user_key)
+
+    def add(self, entries):
+        """Adds entries, ignoring those already archived"""
+        rows = dict(self.rows or {})
+        for entry in entries:
+            rows[str(entry['id'])] = entry
+        self.rows = rows
+
+    def entries(self):
+        return [self.rows[score_id] for score_id in sorted(self.rows)]
+
+
+class ScoreCompaction(ndb.Model):
+    """Progress of the Score compaction task chain. pending names the
+    ScoreArchive whose Scores are being folded into the per-user archives
+    and the archive board and then deleted."""
+    ID = 'scores'
+
+    run = ndb.StringProperty(indexed=False)
+    updated = ndb.DateTimeProperty(required=True, auto_now=True, indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+    pending = ndb.StringProperty(indexed=False)
+    steps = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    archived = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+class ReminderRun(ndb.Model):
+    """Progress of one run of the reminder email cron, checkpointed after
+    every fan-out step so that a failed run resumes where it stopped"""
+    started = ndb.DateTimeProperty(required=True, auto_now_add=True)
+    updated = ndb.DateTimeProperty(required=True, auto_now=True, indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+    completed = ndb.DateTimeProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    pages = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    users = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    sent = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    resumes = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+class ReminderPage(ndb.Model):
+    """One page of a ReminderRun handed to a send_reminders task, keyed by
+    run id and page number. It is claimed before any email of the page is
+    sent, so a retried task never sends the page twice, and holds the
+    number sent once the page is done."""
+    started = ndb.DateTimeProperty(required=True, auto_now_add=True, indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+    sent = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    @classmethod
+    def key_for(cls, run_id, page):
+        return ndb.Key(cls, '{}:{}'.format(run_id, page))
+
+    @classmethod
+    @ndb.transactional
+    def claim(cls, key):
+        """Creates and returns the page, or returns None if an earlier
+        attempt has already claimed it"""
+        if key.get():
+            return None
+        page = cls(key=key)
+        page.put()
+        return page
+
+
+class Backfill(ndb.Model):
+    """Progress of a resumable data migration, keyed by name, checkpointed
+    after every batch. Readers keep to the old read path until it has
+    completed."""
+    USER_NAMES = 'user_names'
+    USER_STATS = 'user_stats'
+    LAST_ACTIVITY = 'last_activity'
+
+    started = ndb.DateTimeProperty(required=True, auto_now_add=True, indexed=False)
+    updated = ndb.DateTimeProperty(required=True, auto_now=True, indexed=False)
+    completed = ndb.DateTimeProperty(indexed=False)
+    kind = ndb.StringProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    steps = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    entities = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    resumes = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    @classmethod
+    def is_complete(cls, name):
+        backfill = cls.get_by_id(name)
+        return bool(backfill and backfill.completed)
+
 
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
@@ -102,9 +651,18 @@ class GameForm(messages.Message):
     won = messages.BooleanField(8, required=True)
 
 
+class MoveErrorForm(messages.Message):
+    """MoveErrorForm for a move in a batch that could not be applied"""
+    index = messages.IntegerField(1, required=True)
+    urlsafe_game_key = messages.StringField(2)
+    message = messages.StringField(3, required=True)
+
+
 class GameForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+    errors = messages.MessageField(MoveErrorForm, 3, repeated=True)
 
 
 class NewGameForm(messages.Message):
@@ -119,6 +677,18 @@ class MakeMoveForm(messages.Message):
     user_name = messages.StringField(2, required=True)
 
 
+class MoveForm(messages.Message):
+    """One move in a batch of moves"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    user_name = messages.StringField(2, required=True)
+    pick_a_date = messages.IntegerField(3, required=True)
+
+
+class MakeMovesForm(messages.Message):
+    """Used to make a batch of moves, possibly across many games"""
+    moves = messages.MessageField(MoveForm, 1, repeated=True)
+
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_name = messages.StringField(1, required=True)
@@ -131,6 +701,24 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+
+
+class GuessCountForm(messages.Message):
+    """Number of finished games that took a given number of guesses"""
+    guesses = messages.IntegerField(1, required=True)
+    games = messages.IntegerField(2, required=True)
+
+
+class UserStatsForm(messages.Message):
+    """UserStatsForm for a User's rollup of finished games"""
+    user_name = messages.StringField(1, required=True)
+    games = messages.IntegerField(2, required=True)
+    wins = messages.IntegerField(3, required=True)
+    win_rate = messages.FloatField(4, required=True)
+    total_guesses = messages.IntegerField(5, required=True)
+    average_guesses = messages.FloatField(6, required=True)
+    guess_histogram = messages.MessageField(GuessCountForm, 7, repeated=True)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,123 @@
+"""test_api.py - Tests of the endpoint methods in api.py."""
+
+import datetime
+import unittest
+
+from testing import AppEngineTestCase
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+import api
+from api import GetYourBonusDayApi, COMMIT_FAILED, MAX_GAMES_PER_COMMIT
+from models import User, Game, Score, UserStats, AttemptsRemainingShard, MakeMovesForm, MoveForm
+
+
+class MakeMovesTest(AppEngineTestCase):
+
+    def setUp(self):
+        super(MakeMovesTest, self).setUp()
+        self.user = User.insert('alice')
+        self.api = GetYourBonusDayApi()
+
+    def new_games(self, number, attempts=1, target=20):
+        """Creates unfinished Games, counted in the running aggregate"""
+        games = [Game.new_game(self.user.key, attempts, self.user.name) for _ in range(number)]
+        for game in games:
+            game.target = target
+        ndb.put_multi(games)
+        AttemptsRemainingShard.adjust(attempts * number, number)
+        return games
+
+    def make_moves(self, *moves):
+        return self.api.make_moves(MakeMovesForm(moves=[
+            MoveForm(urlsafe_game_key=urlsafe_game_key, user_name=user_name, pick_a_date=pick_a_date)
+            for urlsafe_game_key, user_name, pick_a_date in moves]))
+
+    def assertAggregateConsistent(self):
+        games = [game for game in Game.query() if not game.game_over]
+        self.assertEqual(AttemptsRemainingShard.totals(),
+                         (sum(game.attempts_remaining for game in games), len(games)))
+
+    def test_every_game_can_end_across_commits(self):
+        # Each game has one attempt, so every move ends its game, storing a
+        # Score and enqueueing a leaderboard task.
+        games = self.new_games(2 * MAX_GAMES_PER_COMMIT + 2)
+        response = self.make_moves(*[(game.key.urlsafe(), 'alice', 1) for game in games])
+
+        self.assertEqual(response.errors, [])
+        self.assertEqual([form.urlsafe_key for form in response.items], [game.key.urlsafe() for game in games])
+        self.assertTrue(all(form.game_over for form in response.items))
+        self.assertEqual(Score.query().count(), len(games))
+        self.assertEqual(UserStats.key_for(self.user.key).get().games, len(games))
+        self.assertAggregateConsistent()
+
+    def test_moves_on_one_game_apply_in_order(self):
+        game, = self.new_games(1, attempts=3)
+        response = self.make_moves((game.key.urlsafe(), 'alice', 10), (game.key.urlsafe(), 'alice', 25))
+
+        self.assertEqual([form.attempts_remaining for form in response.items], [2, 1])
+        self.assertEqual(game.key.get().attempts_remaining, 1)
+        self.assertAggregateConsistent()
+
+    def test_rejected_moves_carry_their_index(self):
+        game, = self.new_games(1, attempts=3)
+        other = User.insert('bob')
+        missing = Game(user=self.user.key, target=1, attempts_allowed=1).put()
+        missing.delete()
+        response = self.make_moves((game.key.urlsafe(), 'nobody', 1),
+                                   ('not-a-key', 'alice', 1),
+                                   (missing.urlsafe(), 'alice', 1),
+                                   (game.key.urlsafe(), other.name, 1),
+                                   (game.key.urlsafe(), 'alice', 40))
+
+        self.assertEqual([error.index for error in response.errors], [0, 1, 2, 3])
+        self.assertEqual([form.message for form in response.items], ['Invalid guess! No such date!'])
+
+    def test_failed_commit_rejects_only_its_moves(self):
+        games = self.new_games(MAX_GAMES_PER_COMMIT + 1, attempts=3)
+        commit_moves_async = GetYourBonusDayApi._commit_moves_async
+        commits = []
+
+        def fail_second_commit(user_key, moves):
+            commits.append(moves)
+            if len(commits) == 2:
+                raise datastore_errors.TransactionFailedError('too much contention')
+            return commit_moves_async(user_key, moves)
+        api.GetYourBonusDayApi._commit_moves_async = staticmethod(fail_second_commit)
+        try:
+            response = self.make_moves(*[(game.key.urlsafe(), 'alice', 10) for game in games])
+        finally:
+            api.GetYourBonusDayApi._commit_moves_async = staticmethod(commit_moves_async)
+
+        self.assertEqual(len(response.items), MAX_GAMES_PER_COMMIT)
+        self.assertEqual([(error.index, error.message) for error in response.errors],
+                         [(MAX_GAMES_PER_COMMIT, COMMIT_FAILED)])
+        self.assertEqual([game.key.get().attempts_remaining for game in games],
+                         [2] * MAX_GAMES_PER_COMMIT + [3])
+        self.assertAggregateConsistent()
+
+
+    def test_only_valid_guesses_stamp_activity(self):
+        game, = self.new_games(1, attempts=3)
+        idle = datetime.datetime(2000, 1, 1)
+        game.last_activity = idle
+        game.put()
+        urlsafe_game_key = game.key.urlsafe()
+
+        self.make_moves((urlsafe_game_key, 'alice', 40))
+        self.assertEqual(game.key.get().last_activity, idle)
+
+        self.make_moves((urlsafe_game_key, 'alice', 20))
+        game = game.key.get()
+        self.assertTrue(game.game_over)
+        self.assertGreater(game.last_activity, idle)
+
+        stamped = game.last_activity
+        response = self.make_moves((urlsafe_game_key, 'alice', 10))
+        self.assertEqual(response.items[0].message, 'Game already over!')
+        self.assertEqual(game.key.get().last_activity, stamped)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""test_main.py - Tests of the cron and task handlers in main.py."""
+
+import datetime
+import unittest
+
+from testing import AppEngineTestCase
+
+import webapp2
+from google.appengine.ext import ndb, testbed
+
+import main
+from models import User, Game, Score, UserStats, AttemptsRemainingShard, ReminderRun, Backfill, Leaderboard, ScoreArchive, UserScoreArchive, \
+    ScoreCompaction
+
+
+class HandlerTestCase(AppEngineTestCase):
+
+    def request(self, url, method='GET', **params):
+        request = webapp2.Request.blank(url, method=method, POST=params if method == 'POST' else None)
+        response = request.get_response(main.app)
+        self.assertLess(response.status_int, 300, url)
+
+
+class ReminderTest(HandlerTestCase):
+
+    def setUp(self):
+        super(ReminderTest, self).setUp()
+        self.mail = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        for name in ('alice', 'bob', 'carol'):
+            User.insert(name, email='{}@example.com'.format(name))
+
+    def test_run_sends_each_user_one_email(self):
+        self.request('/crons/send_reminder')
+        self.run_tasks()
+
+        run = ReminderRun.query().get()
+        self.assertIsNotNone(run.completed)
+        self.assertEqual((run.users, run.sent), (3, 3))
+        self.assertEqual(len(self.mail.get_sent_messages()), 3)
+
+    def test_retried_page_is_not_sent_again(self):
+        self.request('/crons/send_reminder')
+        self.run_tasks()
+        run = ReminderRun.query().get()
+
+        self.request('/tasks/send_reminders', method='POST', run_id=str(run.key.id()), page='0',
+                     user_keys=','.join(user.key.urlsafe() for user in User.query()))
+        self.assertEqual(len(self.mail.get_sent_messages()), 3)
+        self.assertEqual(run.key.get().sent, 3)
+
+
+class CompactScoresTest(HandlerTestCase):
+
+    def setUp(self):
+        super(CompactScoresTest, self).setUp()
+        for name in (Backfill.USER_NAMES, Backfill.USER_STATS):
+            Backfill(id=name, completed=datetime.datetime.utcnow()).put()
+        self.users = [User.insert(name) for name in ('alice', 'bob')]
+        expired = datetime.date.today() - datetime.timedelta(days=main.SCORE_RETENTION_DAYS + 1)
+        scores = []
+        for day in (expired - datetime.timedelta(days=1), expired, datetime.date.today()):
+            for number, user in enumerate(self.users * 3):
+                scores.append(Score(id='{}-{}'.format(day.isoformat(), number), user=user.key,
+                                    user_name=user.name, date=day, won=number % 2 == 0,
+                                    guesses=number + 1, num_of_wons=number, attempts_allowed=5))
+        ndb.put_multi(scores)
+
+    def archived_state(self):
+        """Returns everything compaction writes to, as comparable values"""
+        board = Leaderboard.get_by_id(Leaderboard.ARCHIVE_ID)
+        return (sorted(score.key.id() for score in Score.query()),
+                sorted((summary.key.urlsafe(), summary.entries()) for summary in UserScoreArchive.query()),
+                board.high_scores, board.rankings)
+
+    def test_compaction_is_idempotent(self):
+        self.request('/crons/compact_scores')
+        self.run_tasks()
+
+        compaction = ScoreCompaction.get_by_id(ScoreCompaction.ID)
+        self.assertIsNotNone(compaction.finished)
+        self.assertEqual(compaction.archived, 12)
+        self.assertEqual(Score.query().count(), 6)
+        self.assertEqual(UserScoreArchive.query().count(), 4)
+        state = self.archived_state()
+        self.assertEqual(len(state[2]), 12)
+
+        # A retried step applies its archive again.
+        for archive in ScoreArchive.query():
+            main._apply_archive(archive)
+        self.assertEqual(self.archived_state(), state)
+
+
+
+class ReapGamesTest(HandlerTestCase):
+
+    def setUp(self):
+        super(ReapGamesTest, self).setUp()
+        user = User.insert('alice')
+        self.stats_key = UserStats.key_for(user.key)
+        now = datetime.datetime.utcnow()
+        self.idle, self.recent, self.unstamped = [Game.new_game(user.key, 3, user.name) for _ in range(3)]
+        self.idle.last_activity = now - main.GAME_EXPIRE_AFTER - datetime.timedelta(hours=1)
+        self.recent.last_activity = now - main.GAME_EXPIRE_AFTER + datetime.timedelta(hours=1)
+        self.unstamped.last_activity = None
+        ndb.put_multi([self.idle, self.recent, self.unstamped])
+        AttemptsRemainingShard.adjust(9, 3)
+
+    def test_expires_only_the_idle_games(self):
+        self.request('/crons/reap_games')
+        self.run_tasks()
+
+        idle, recent, unstamped = ndb.get_multi([self.idle.key, self.recent.key, self.unstamped.key])
+        self.assertTrue(idle.game_over)
+        self.assertFalse(idle.won)
+        self.assertEqual(idle.get_history()[-1]['message'], 'Game expired after inactivity.')
+        self.assertIsNotNone(Score.get_by_id(str(idle.key.id())))
+        self.assertEqual(self.stats_key.get().games, 1)
+        for game, before in ((recent, self.recent), (unstamped, self.unstamped)):
+            self.assertFalse(game.game_over)
+            self.assertEqual(game.last_activity, before.last_activity)
+        self.assertEqual(AttemptsRemainingShard.totals(), (6, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
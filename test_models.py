@@ -0,0 +1,140 @@
+"""test_models.py - Tests of the entity helpers in models.py."""
+
+import datetime
+import unittest
+
+from testing import AppEngineTestCase
+
+from google.appengine.ext import ndb
+
+from models import User, Game, Score, UserStats, Leaderboard, LEADERBOARD_SIZE
+
+
+def entry(score_id, num_of_wons):
+    return {'id': score_id, 'num_of_wons': num_of_wons, 'won': True}
+
+
+class LeaderboardInsertTest(unittest.TestCase):
+
+    def ids(self, entries):
+        return [existing['id'] for existing in entries]
+
+    def test_orders_by_wins_with_ties_in_arrival_order(self):
+        entries = []
+        for score_id, num_of_wons in (('a', 3), ('b', 5), ('c', 3), ('d', 5), ('e', 1)):
+            self.assertTrue(Leaderboard._insert(entries, entry(score_id, num_of_wons)))
+        self.assertEqual(self.ids(entries), ['b', 'd', 'a', 'c', 'e'])
+
+    def test_ignores_an_entry_already_listed(self):
+        entries = [entry('a', 3)]
+        self.assertFalse(Leaderboard._insert(entries, entry('a', 4)))
+        self.assertEqual(entries, [entry('a', 3)])
+
+    def test_full_list_keeps_its_size(self):
+        entries = [entry(str(index), 10) for index in range(LEADERBOARD_SIZE)]
+        # A tie with the last entry does not place once the list is full.
+        self.assertFalse(Leaderboard._insert(entries, entry('tie', 10)))
+        self.assertFalse(Leaderboard._insert(entries, entry('low', 9)))
+        self.assertEqual(len(entries), LEADERBOARD_SIZE)
+
+        self.assertTrue(Leaderboard._insert(entries, entry('high', 11)))
+        self.assertEqual(len(entries), LEADERBOARD_SIZE)
+        self.assertEqual(entries[0]['id'], 'high')
+        self.assertEqual(entries[-1]['id'], str(LEADERBOARD_SIZE - 2))
+
+
+class GameHistoryTest(AppEngineTestCase):
+    # History as games stored before the compact form pickled it.
+    LEGACY = [{'message': 'You guessed higher.', 'nth_guess': 1},
+              {'message': 'Invalid guess! No such date!', 'nth_guess': 1}]
+
+    def stored(self, game):
+        """Returns the Game as read back from the datastore"""
+        game.put()
+        ndb.get_context().clear_cache()
+        return game.key.get()
+
+    def new_game(self, **values):
+        return Game(user=ndb.Key('User', 'player'), target=10, attempts_allowed=5, attempts_remaining=5,
+                    **values)
+
+    def test_new_game_has_no_history(self):
+        self.assertEqual(self.stored(self.new_game()).get_history(), [])
+
+    def test_compact_history(self):
+        game = self.new_game()
+        game.add_game_history('You guessed lower.', 1)
+        game.add_game_history('Congratulations! You picked the correct date.', 2)
+        self.assertEqual(self.stored(game).get_history(),
+                         [{'message': 'You guessed lower.', 'nth_guess': 1},
+                          {'message': 'Congratulations! You picked the correct date.', 'nth_guess': 2}])
+
+    def test_legacy_history(self):
+        game = self.stored(self.new_game(legacy_history=list(self.LEGACY)))
+        self.assertEqual(game.get_history(), self.LEGACY)
+
+    def test_legacy_history_is_followed_by_new_entries(self):
+        game = self.stored(self.new_game(legacy_history=list(self.LEGACY)))
+        game.add_game_history('Incorrect. Game over!', 2)
+        self.assertEqual(self.stored(game).get_history(),
+                         self.LEGACY + [{'message': 'Incorrect. Game over!', 'nth_guess': 2}])
+
+    def test_unknown_message_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.new_game().add_game_history('Not a history message.', 1)
+
+
+
+class UserStatsSeedTest(AppEngineTestCase):
+
+    def setUp(self):
+        super(UserStatsSeedTest, self).setUp()
+        # A User stored before the rollup existed.
+        self.user_key = User(id='alice', name='alice').put()
+
+    def new_score(self, score_id, won, guesses):
+        score = Score(id=score_id, user=self.user_key, user_name='alice', date=datetime.date.today(),
+                      won=won, guesses=guesses)
+        score.put()
+        return score
+
+    def stats(self):
+        return UserStats.key_for(self.user_key).get()
+
+    def test_seeds_the_scores_finished_before_the_rollup(self):
+        scores = [self.new_score('1', True, 2), self.new_score('2', False, 5)]
+        self.assertTrue(UserStats.seed_async(self.user_key, scores).get_result())
+
+        stats = self.stats()
+        self.assertTrue(stats.seeded)
+        self.assertEqual((stats.games, stats.wins, stats.total_guesses), (2, 1, 7))
+        self.assertEqual(stats.guess_histogram, {'2': 1, '5': 1})
+
+    def test_scores_recorded_before_seeding_count_once(self):
+        scores = [self.new_score('1', True, 2)]
+        # A game ends after the rollup was created but before it is seeded.
+        stats = UserStats(key=UserStats.key_for(self.user_key))
+        later = self.new_score('2', True, 3)
+        stats.record(later)
+        stats.put()
+        self.assertEqual(stats.recorded, ['2'])
+
+        self.assertTrue(UserStats.seed_async(self.user_key, scores + [later]).get_result())
+        stats = self.stats()
+        self.assertEqual((stats.games, stats.wins, stats.total_guesses), (2, 2, 5))
+        self.assertEqual(stats.recorded, [])
+
+    def test_seeding_twice_changes_nothing(self):
+        scores = [self.new_score('1', True, 2)]
+        self.assertTrue(UserStats.seed_async(self.user_key, scores).get_result())
+        self.assertFalse(UserStats.seed_async(self.user_key, scores).get_result())
+        self.assertEqual(self.stats().games, 1)
+
+        # Scores recorded once seeded are not listed.
+        stats = self.stats()
+        stats.record(self.new_score('2', False, 4))
+        self.assertEqual((stats.games, stats.recorded), (2, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""test_utils.py - Tests of the helpers in utils.py."""
+
+import unittest
+
+from testing import AppEngineTestCase
+
+import endpoints
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import utils
+from cache import LRUCache
+from models import User
+from utils import fetch_rows_page, get_user_keys, remember_user_key, MEMCACHE_USER_KEY, USER_MISSING
+
+
+class Chunk(ndb.Model):
+    """Entity holding a list of rows, as a ScoreArchive does"""
+    position = ndb.IntegerProperty()
+    rows = ndb.JsonProperty()
+
+
+class FetchRowsPageTest(AppEngineTestCase):
+    # Row counts of the stored entities, including an empty one.
+    SIZES = (3, 1, 0, 4, 2, 5)
+
+    def setUp(self):
+        super(FetchRowsPageTest, self).setUp()
+        self.rows = []
+        chunks = []
+        for position, size in enumerate(self.SIZES):
+            rows = ['{}-{}'.format(position, index) for index in range(size)]
+            chunks.append(Chunk(position=position, rows=rows))
+            self.rows.extend(rows)
+        ndb.put_multi(chunks)
+        self.query = Chunk.query().order(Chunk.position)
+
+    def fetch(self, page_size, page_token):
+        return fetch_rows_page(self.query, lambda chunk: chunk.rows, page_size, page_token)
+
+    def fetch_all(self, page_size):
+        """Returns every page, following the tokens from the first page"""
+        pages = []
+        token = None
+        while True:
+            page, token = self.fetch(page_size, token)
+            pages.append(page)
+            if not token:
+                return pages
+            self.assertLess(len(pages), len(self.rows), 'the tokens do not advance')
+
+    def test_pages_return_every_row_once_in_order(self):
+        for page_size in range(1, len(self.rows) + 2):
+            pages = self.fetch_all(page_size)
+            self.assertEqual([row for page in pages for row in page], self.rows, page_size)
+            for page in pages[:-1]:
+                self.assertEqual(len(page), page_size, page_size)
+            self.assertTrue(0 < len(pages[-1]) <= page_size, page_size)
+
+    def test_token_resumes_inside_an_entity(self):
+        page, token = self.fetch(2, None)
+        self.assertEqual(page, ['0-0', '0-1'])
+        page, token = self.fetch(2, token)
+        self.assertEqual(page, ['0-2', '1-0'])
+
+    def test_token_resumes_at_an_entity_boundary(self):
+        page, token = self.fetch(4, None)
+        self.assertEqual(page, ['0-0', '0-1', '0-2', '1-0'])
+        page, token = self.fetch(4, token)
+        self.assertEqual(page, ['3-0', '3-1', '3-2', '3-3'])
+
+    def test_last_page_has_no_token(self):
+        page, token = self.fetch(len(self.rows), None)
+        self.assertEqual(page, self.rows)
+        self.assertIsNone(token)
+
+    def test_invalid_token_is_rejected(self):
+        for token in ('no-offset', ':not-a-number'):
+            with self.assertRaises(endpoints.BadRequestException):
+                self.fetch(2, token)
+
+    def test_invalid_page_size_is_rejected(self):
+        with self.assertRaises(endpoints.BadRequestException):
+            self.fetch(0, None)
+
+
+
+class UserKeyCacheTest(AppEngineTestCase):
+
+    def forget_local_keys(self):
+        """Empties the in-process cache, as on another instance"""
+        utils._user_keys = LRUCache(utils.USER_KEY_CACHE_SIZE)
+
+    def test_resolves_names_and_caches_them(self):
+        key = User.insert('alice').key
+        self.assertEqual(get_user_keys(['alice', 'bob', '']), {'alice': key, 'bob': None, '': None})
+        self.assertEqual(memcache.get(MEMCACHE_USER_KEY + 'alice'), key.urlsafe())
+        self.assertEqual(memcache.get(MEMCACHE_USER_KEY + 'bob'), USER_MISSING)
+
+        # Later lookups are served from the caches alone.
+        key.delete()
+        self.assertEqual(get_user_keys(['alice'])['alice'], key)
+        self.forget_local_keys()
+        self.assertEqual(get_user_keys(['alice'])['alice'], key)
+
+    def test_finds_users_not_keyed_by_name(self):
+        key = User(name='carol').put()
+        self.assertEqual(get_user_keys(['carol'])['carol'], key)
+
+    def test_created_user_replaces_the_negative_entry(self):
+        self.assertIsNone(get_user_keys(['dave'])['dave'])
+        user = User.insert('dave')
+        remember_user_key(user.key, 'dave')
+        self.forget_local_keys()
+        self.assertEqual(get_user_keys(['dave'])['dave'], user.key)
+
+    def test_negative_entry_never_replaces_a_created_user(self):
+        # The User is created after the lookup has missed memcache, while it
+        # reads the datastore.
+        key = ndb.Key(User, 'erin')
+        get_multi_async = ndb.get_multi_async
+
+        def get_multi_while_created(keys, **options):
+            future = get_multi_async(keys, **options)
+            remember_user_key(key, 'erin')
+            return future
+        ndb.get_multi_async = get_multi_while_created
+        try:
+            self.assertIsNone(get_user_keys(['erin'])['erin'])
+        finally:
+            ndb.get_multi_async = get_multi_async
+
+        self.assertEqual(memcache.get(MEMCACHE_USER_KEY + 'erin'), key.urlsafe())
+        self.forget_local_keys()
+        self.assertEqual(get_user_keys(['erin'])['erin'], key)
+
+
+if __name__ == '__main__':
+    unittest.main()
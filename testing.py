@@ -0,0 +1,63 @@
+"""testing.py - Shared setup of the test_*.py unit tests.
+
+Requires the App Engine SDK on sys.path (or importable dev_appserver):
+
+    python -m unittest discover -p 'test_*.py'"""
+
+import os
+import unittest
+
+try:
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+except ImportError:
+    pass
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+class AppEngineTestCase(unittest.TestCase):
+    """Runs each test against fresh datastore, memcache and taskqueue stubs.
+    Queries are strongly consistent, and the in-process caches are emptied
+    so no entity of an earlier test is served."""
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_mail_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+        import cache
+        import utils
+        cache._entities = cache.LRUCache(cache.ENTITY_CACHE_SIZE)
+        utils._user_keys = cache.LRUCache(utils.USER_KEY_CACHE_SIZE)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def run_tasks(self):
+        """Runs queued tasks through the main.py handlers, including any they
+        enqueue, until the queues are empty. Returns the URLs run."""
+        import webapp2
+        import main
+        urls = []
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks()
+            if not tasks:
+                return urls
+            for task in tasks:
+                self.taskqueue.DeleteTask(task.queue_name or 'default', task.name)
+                request = webapp2.Request.blank(task.url, method=task.method,
+                                                body=task.payload, headers=task.headers)
+                ndb.get_context().clear_cache()
+                response = request.get_response(main.app)
+                self.assertLess(response.status_int, 300, task.url)
+                urls.append(task.url)
@@ -1,24 +1,249 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+import threading
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+from cache import LRUCache, CachedModel, get_cached_entity_async
+from models import User
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+USER_KEY_CACHE_SIZE = 10000
+MEMCACHE_USER_KEY = 'USER_KEY:'
+# Memcache marker for names that do not belong to any User.
+USER_MISSING = '-'
+USER_MISSING_TTL = 600
+URLSAFE_KEY_CACHE_SIZE = 10000
+
+
+def _page_size(page_size):
+    if page_size is None:
+        return DEFAULT_PAGE_SIZE
+    if page_size < 1:
+        raise endpoints.BadRequestException('page_size must be positive')
+    return min(page_size, MAX_PAGE_SIZE)
+
+
+def fetch_page(query, page_size, page_token):
+    """Fetches one page of query results; see fetch_page_async"""
+    return fetch_page_async(query, page_size, page_token).get_result()
+
+
+@ndb.tasklet
+def fetch_page_async(query, page_size, page_token):
+    """Fetches one page of query results using an ndb query cursor.
     Args:
-        urlsafe: A urlsafe key string
-        model: The expected entity kind
+        query: The ndb.Query to page through
+        page_size: The requested page size; defaults to DEFAULT_PAGE_SIZE and
+            is capped at MAX_PAGE_SIZE
+        page_token: The opaque token returned with the previous page, or None
+            for the first page
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The results and the token for the next page, or None on the last page.
     Raises:
-        ValueError:"""
+        endpoints.BadRequestException: The page_size or page_token is invalid"""
+    page_size = _page_size(page_size)
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        cursor = Cursor(urlsafe=page_token) if page_token else None
+        results, next_cursor, more = yield query.fetch_page_async(page_size, start_cursor=cursor)
+    except (TypeError, datastore_errors.BadValueError, datastore_errors.BadRequestError):
+        raise endpoints.BadRequestException('Invalid page_token')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid page_token')
+        else:
+            raise
+    if not more or not next_cursor:
+        raise ndb.Return((results, None))
+    raise ndb.Return((results, next_cursor.urlsafe()))
+
+
+def fetch_rows_page(query, rows_of, page_size, page_token):
+    """Fetches one page of the rows packed into the entities of a query,
+    such as archived Scores.
+    Args:
+        query: The ndb.Query of the entities holding the rows
+        rows_of: A function returning the list of rows of an entity
+        page_size: As with fetch_page
+        page_token: As with fetch_page
+    Returns:
+        The rows and the token for the next page, or None on the last page.
+        The token holds the cursor of the entity to resume from and the
+        number of its rows already returned."""
+    page_size = _page_size(page_size)
+    rows = []
+    try:
+        cursor, offset = page_token.rsplit(':', 1) if page_token else ('', '0')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+        offset = int(offset)
+        iterator = query.iter(start_cursor=cursor, produce_cursors=True, batch_size=10)
+        for entity in iterator:
+            entity_rows = rows_of(entity)
+            taken = entity_rows[offset:offset + page_size - len(rows)]
+            rows.extend(taken)
+            offset += len(taken)
+            if offset < len(entity_rows):
+                return rows, '{}:{}'.format(cursor.urlsafe() if cursor else '', offset)
+            cursor, offset = iterator.cursor_after(), 0
+            if len(rows) == page_size:
+                return rows, '{}:0'.format(cursor.urlsafe()) if iterator.has_next() else None
+    except (ValueError, TypeError, datastore_errors.BadValueError, datastore_errors.BadRequestError):
+        raise endpoints.BadRequestException('Invalid page_token')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid page_token')
+        else:
+            raise
+    return rows, None
+
+
+def page_list(items, page_size, page_token):
+    """Returns one page of an in-memory list and the token for the next page,
+    or None on the last page. Tokens are opaque to clients, as with
+    fetch_page."""
+    page_size = _page_size(page_size)
+    try:
+        offset = int(page_token) if page_token else 0
+    except ValueError:
+        raise endpoints.BadRequestException('Invalid page_token')
+    if offset < 0:
+        raise endpoints.BadRequestException('Invalid page_token')
+    end = offset + page_size
+    return items[offset:end], str(end) if end < len(items) else None
+
+
+_user_keys = LRUCache(USER_KEY_CACHE_SIZE)
+_user_cache_stats = {'local_hits': 0, 'memcache_hits': 0,
+                     'negative_hits': 0, 'misses': 0}
+_user_cache_stats_lock = threading.Lock()
+
+
+def _count_user_lookups(stat, count=1):
+    if count:
+        with _user_cache_stats_lock:
+            _user_cache_stats[stat] += count
+
+
+def user_cache_stats():
+    """Returns a snapshot of this instance's User lookup hit/miss counters"""
+    with _user_cache_stats_lock:
+        stats = dict(_user_cache_stats)
+    stats['local_size'] = len(_user_keys)
+    return stats
+
+
+def get_user_keys(user_names):
+    """Resolves user names to User keys; see get_user_keys_async"""
+    return get_user_keys_async(user_names).get_result()
+
+
+@ndb.tasklet
+def get_user_keys_async(user_names):
+    """Resolves user names to User keys. Lookups go through a bounded
+    in-process LRU, then memcache (which also remembers unknown names), then
+    the datastore, where Users are keyed by name. Users created before that
+    keying are found by a query on User.name.
+    Args:
+        user_names: An iterable of user names
+    Returns:
+        A dict of name -> User key, or None for names with no User."""
+    keys = {}
+    pending = []
+    for name in set(user_names):
+        key = _user_keys.get(name) if name else None
+        if key:
+            keys[name] = key
+        elif name:
+            pending.append(name)
+        else:
+            keys[name] = None
+    _count_user_lookups('local_hits', len(keys))
+    if not pending:
+        raise ndb.Return(keys)
+
+    # The context batches these into a single memcache get.
+    context = ndb.get_context()
+    values = yield [context.memcache_get(MEMCACHE_USER_KEY + name) for name in pending]
+    missing = []
+    for name, value in zip(pending, values):
+        if value == USER_MISSING:
+            keys[name] = None
+            _count_user_lookups('negative_hits')
+        elif value:
+            keys[name] = ndb.Key(urlsafe=value)
+            _user_keys.set(name, keys[name])
+            _count_user_lookups('memcache_hits')
+        else:
+            missing.append(name)
+    if not missing:
+        raise ndb.Return(keys)
+
+    _count_user_lookups('misses', len(missing))
+    users = yield ndb.get_multi_async([ndb.Key(User, name) for name in missing])
+    legacy = [name for name, user in zip(missing, users) if not user]
+    legacy_keys = yield [User.query(User.name == name).get_async(keys_only=True)
+                         for name in legacy]
+    found = dict((name, user.key) for name, user in zip(missing, users) if user)
+    found.update(zip(legacy, legacy_keys))
+    updates = []
+    for name in missing:
+        key = found.get(name)
+        keys[name] = key
+        if key:
+            _user_keys.set(name, key)
+            updates.append(context.memcache_set(MEMCACHE_USER_KEY + name, key.urlsafe()))
+        else:
+            # Added, never set, so that it cannot replace the key a
+            # create_user stored since this lookup missed.
+            updates.append(context.memcache_add(MEMCACHE_USER_KEY + name, USER_MISSING,
+                                                time=USER_MISSING_TTL))
+    yield updates
+    raise ndb.Return(keys)
+
+
+def get_user(user_name):
+    """Returns the User with the given name or None if no such User exists"""
+    return get_user_async(user_name).get_result()
+
+
+@ndb.tasklet
+def get_user_async(user_name):
+    keys = yield get_user_keys_async([user_name])
+    user = None
+    if keys[user_name]:
+        user = yield keys[user_name].get_async()
+    raise ndb.Return(user)
+
+
+def remember_user_key(user_key, user_name):
+    """Records a newly created User in the lookup caches, replacing any
+    cached 'unknown name' marker"""
+    _user_keys.set(user_name, user_key)
+    memcache.set(MEMCACHE_USER_KEY + user_name, user_key.urlsafe())
+
+
+_parsed_keys = LRUCache(URLSAFE_KEY_CACHE_SIZE)
+
+
+def parse_urlsafe(urlsafe):
+    """Returns the ndb.Key for a urlsafe key string without fetching it.
+    Parsed keys are memoized. Raises endpoints.BadRequestException if the
+    string is malformed."""
+    key = _parsed_keys.get(urlsafe)
+    if key is None:
+        key = _parse_urlsafe(urlsafe)
+        _parsed_keys.set(urlsafe, key)
+    return key
+
+
+def _parse_urlsafe(urlsafe):
+    try:
+        return ndb.Key(urlsafe=urlsafe)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -27,9 +252,35 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
+
+def get_by_urlsafe(urlsafe, model, cached=False):
+    """Returns the entity a urlsafe key points to; see get_by_urlsafe_async"""
+    return get_by_urlsafe_async(urlsafe, model, cached).get_result()
+
+
+@ndb.tasklet
+def get_by_urlsafe_async(urlsafe, model, cached=False):
+    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+        that the type of entity returned is of the correct kind. Raises an
+        error if the key String is malformed or the entity is of the incorrect
+        kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+        cached: If True and model is a CachedModel, read through the entity
+            cache. The entity returned is shared and must not be modified.
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    key = parse_urlsafe(urlsafe)
+    if cached and issubclass(model, CachedModel):
+        entity = yield get_cached_entity_async(key)
+    else:
+        entity = yield key.get_async()
     if not entity:
-        return None
+        raise ndb.Return(None)
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
-    return entity
+    raise ndb.Return(entity)